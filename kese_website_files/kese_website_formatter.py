@@ -1,10 +1,12 @@
+import io
+import os
+import glob
+import tempfile
+import functools
 import pandas as pd
-import numpy as np
-import sys
 import tools.constants as c
-from functools import reduce
 
-pd.set_option('max_columns', 1000)
+pd.set_option('display.max_columns', 1000)
 pd.set_option('max_info_columns', 1000)
 pd.set_option('expand_frame_repr', False)
 pd.set_option('display.max_rows', 30000)
@@ -12,157 +14,108 @@ pd.set_option('max_colwidth', 4000)
 pd.set_option('display.float_format', lambda x: '%.8f' % x)
 pd.set_option('chained_assignment',None)
 
-def rne_data_create():
-    # pull state and national
-    state = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_State_1996_2021.xlsx', sheet_name='Rate of New Entrepreneurs')
-    national = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_National_1996_2021.xlsx', sheet_name='Rate of New Entrepreneurs')
-    # rename and create demographic columns
-    national = national.rename(columns={"demtype": "demographic-type"})
-    state.insert(1, 'demographic-type', np.nan)
-    state.insert(2, 'demographic', np.nan)
-    # subset columns
-    national = national[national.columns[pd.Series(national.columns).str.startswith(('sname', 'demo', 'rne_'))]]
-    state = state[state.columns[pd.Series(state.columns).str.startswith(('sname', 'demo', 'rne_'))]]
-    # strip column names
-    national.columns = national.columns.str.lstrip("rne_")
-    national.columns = national.columns.str.lstrip("s")
-    state.columns = state.columns.str.lstrip("rne_")
-    state.columns = state.columns.str.lstrip("s")
-    # concat national and state
-    frames = [national, state]
-    rne = pd.concat(frames)
-    # rename region column and map fips codes
-    rne['name'] = rne['name'].map(c.us_state_abbrev).map(c.state_abb_fips_dic)
-    rne = rne.rename(columns={"name": "region"})
-    # sort by demographic
-    rne = rne.sort_values(by=['demographic-type']).reset_index(drop=True)
-    rne.to_csv(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_kese_website_rne.csv', index=False)
-    return rne
-
-def ose_data_create():
-    # pull state and national
-    state = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_State_1996_2021.xlsx', sheet_name='Opportunity Share of NE')
-    national = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_National_1996_2021.xlsx', sheet_name='Opportunity Share of NE')
-    # rename and create demographic columns
-    national = national.rename(columns={"demtype": "demographic-type"})
-    state.insert(1, 'demographic-type', np.nan)
-    state.insert(2, 'demographic', np.nan)
-    # subset columns
-    national = national[national.columns[pd.Series(national.columns).str.startswith(('sname', 'demo', 'ose_'))]]
-    state = state[state.columns[pd.Series(state.columns).str.startswith(('sname', 'demo', 'ose_'))]]
-    # strip column names
-    national.columns = national.columns.str.lstrip("ose_")
-    national.columns = national.columns.str.lstrip("s")
-    state.columns = state.columns.str.lstrip("ose_")
-    state.columns = state.columns.str.lstrip("s")
-    # concat national and state
-    frames = [national, state]
-    ose = pd.concat(frames)
-    # rename region column and map fips codes
-    ose['name'] = ose['name'].map(c.us_state_abbrev).map(c.state_abb_fips_dic)
-    ose = ose.rename(columns={"name": "region"})
-    # sort by demographic
-    ose = ose.sort_values(by=['demographic-type']).reset_index(drop=True)
-    ose.to_csv(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_kese_website_ose.csv', index=False)
-    return ose
-
-def sjc_data_create():
-    # pull state and national
-    state = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_State_1996_2021.xlsx', sheet_name='Startup Job Creation')
-    national = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_National_1996_2021.xlsx', sheet_name='Startup Job Creation')
-    # rename and create demographic columns
-    state.insert(1, 'demographic-type', np.nan)
-    state.insert(2, 'demographic', np.nan)
-    national.insert(1, 'demographic-type', np.nan)
-    national.insert(2, 'demographic', np.nan)
-    # subset columns
-    national = national[national.columns[pd.Series(national.columns).str.startswith(('sname', 'demo', 'sjc_'))]]
-    state = state[state.columns[pd.Series(state.columns).str.startswith(('sname', 'demo', 'sjc_'))]]
-    # strip column names
-    national.columns = national.columns.str.lstrip("sjc_")
-    national.columns = national.columns.str.lstrip("s")
-    state.columns = state.columns.str.lstrip("sjc_")
-    state.columns = state.columns.str.lstrip("s")
-    national = national[national.columns.drop(list(national.filter(regex='_jobs')))]
-    state = state[state.columns.drop(list(state.filter(regex='_jobs')))]
-    national = national[national.columns.drop(list(national.filter(regex='_pop')))]
-    state = state[state.columns.drop(list(state.filter(regex='_pop')))]
-    # concat national and state
-    frames = [national, state]
-    sjc = pd.concat(frames)
-    # rename region column and map fips codes
-    sjc['name'] = sjc['name'].map(c.us_state_abbrev).map(c.state_abb_fips_dic)
-    sjc = sjc.rename(columns={"name": "region"})
-    # change column types
-    sjc = sjc.astype({'demographic-type': 'object', 'demographic': 'object'})
-    # sort by demographic
-    sjc = sjc.sort_values(by=['demographic-type']).reset_index(drop=True)
-    sjc.to_csv(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_kese_website_sjc.csv', index=False)
-    return sjc
-
-def ssr_data_create():
-    # pull state and national
-    state = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_State_1996_2021.xlsx', sheet_name='Startup Survival Rate')
-    national = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_National_1996_2021.xlsx', sheet_name='Startup Survival Rate')
-    # rename and create demographic columns
-    state.insert(1, 'demographic-type', np.nan)
-    state.insert(2, 'demographic', np.nan)
-    national.insert(1, 'demographic-type', np.nan)
-    national.insert(2, 'demographic', np.nan)
-    # subset columns
-    national = national[national.columns[pd.Series(national.columns).str.startswith(('sname', 'demo', 'ssr_'))]]
-    state = state[state.columns[pd.Series(state.columns).str.startswith(('sname', 'demo', 'ssr_'))]]
-    national = national[national.columns.drop(list(national.filter(regex='_new')))]
-    state = state[state.columns.drop(list(state.filter(regex='_new')))]
-    national = national[national.columns.drop(list(national.filter(regex='_surv')))]
-    state = state[state.columns.drop(list(state.filter(regex='_surv')))]
-    # strip column names
-    national.columns = national.columns.str.lstrip("ssr_")
-    national.columns = national.columns.str.lstrip("s")
-    state.columns = state.columns.str.lstrip("ssr_")
-    state.columns = state.columns.str.lstrip("s")
-    # concat national and state
-    frames = [national, state]
-    ssr = pd.concat(frames)
-    # rename region column and map fips codes
-    ssr['name'] = ssr['name'].map(c.us_state_abbrev).map(c.state_abb_fips_dic)
-    ssr = ssr.rename(columns={"name": "region"})
-    # change column types
-    ssr = ssr.astype({'demographic-type': 'object', 'demographic': 'object'})
-    # sort by demographic
-    ssr = ssr.sort_values(by=['demographic-type']).reset_index(drop=True)
-    ssr.to_csv(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_kese_website_ssr.csv', index=False)
-    return ssr
-
-def index_data_create():
-    # pull state and national
-    state = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_State_1996_2021.xlsx', sheet_name='KESE Index')
-    national = pd.read_excel(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_National_1996_2021.xlsx', sheet_name='KESE Index')
-    # subset columns
-    national = national[national.columns[pd.Series(national.columns).str.startswith(('sname', 'demo', 'z'))]]
-    state = state[state.columns[pd.Series(state.columns).str.startswith(('sname', 'demo', 'z'))]]
-    # strip column names
-    national.columns = national.columns.str.lstrip("zindex_")
-    national.columns = national.columns.str.lstrip("s")
-    state.columns = state.columns.str.lstrip("zindex_")
-    state.columns = state.columns.str.lstrip("s")
-    # rename and create demographic columns
-    state.insert(1, 'demographic-type', np.nan)
-    state.insert(2, 'demographic', np.nan)
-    national.insert(1, 'demographic-type', np.nan)
-    national.insert(2, 'demographic', np.nan)
-    # concat national and state
-    frames = [national, state]
-    index = pd.concat(frames)
-    # rename region column and map fips codes
-    index['name'] = index['name'].map(c.us_state_abbrev).map(c.state_abb_fips_dic)
-    index = index.rename(columns={"name": "region"})
-    # change column types
-    index = index.astype({'demographic-type': 'object', 'demographic': 'object'})
-    # sort by demographic
-    index = index.sort_values(by=['demographic-type']).reset_index(drop=True)
-    index.to_csv(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_kese_website_zindex.csv', index=False)
-    return index
+workbooks = {
+    'state': 's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_State_1996_2021.xlsx',
+    'national': 's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_rob_kese_files/Kauffman_Indicators_Data_National_1996_2021.xlsx'
+}
+workbook_sheets = [
+    'Rate of New Entrepreneurs', 'Opportunity Share of NE', 'Startup Job Creation', 'Startup Survival Rate', 'KESE Index'
+]
+
+
+@functools.lru_cache(maxsize=None)
+def workbook_load(workbook, cache_dir=c.filenamer('data/cache/workbooks')):
+    """
+    Load the indicator sheets of a workbook. The workbook is downloaded and parsed once, with all sheets
+    in a single read_excel call, and the parsed sheets are cached locally under the ETag of the S3
+    object, so they are only downloaded and parsed again when the workbook changes.
+
+    Parameters
+    ----------
+    workbook : str
+        'state' or 'national'
+
+    cache_dir : str
+        Directory of the cache
+
+    Returns
+    -------
+    dict
+        The sheets, keyed by sheet name
+    """
+    import boto3
+    import joblib
+    bucket, key = workbooks[workbook][len('s3://'):].split('/', 1)
+    client = boto3.client('s3')
+    etag = client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+    path = os.path.join(cache_dir, f'{workbook}_{etag}.pkl')
+    if os.path.isfile(path):
+        return joblib.load(path)
+
+    body = client.get_object(Bucket=bucket, Key=key, IfMatch=etag)['Body'].read()
+    sheets = pd.read_excel(io.BytesIO(body), sheet_name=workbook_sheets)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(cache_dir, f'{workbook}_*.pkl')):
+        os.remove(stale)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    joblib.dump(sheets, tmp_path)
+    os.replace(tmp_path, path)
+    return sheets
+
+
+# The sheet of each indicator, the prefix of its year columns, the substrings of the columns of that
+# prefix that are not indicator values, and whether the national sheet is broken down by demographic
+indicator_specs = {
+    'rne': {'sheet': 'Rate of New Entrepreneurs', 'prefix': 'rne_', 'exclude': [], 'demographics': True},
+    'ose': {'sheet': 'Opportunity Share of NE', 'prefix': 'ose_', 'exclude': [], 'demographics': True},
+    'sjc': {'sheet': 'Startup Job Creation', 'prefix': 'sjc_', 'exclude': ['_jobs', '_pop'], 'demographics': False},
+    'ssr': {'sheet': 'Startup Survival Rate', 'prefix': 'ssr_', 'exclude': ['_new', '_surv'], 'demographics': False},
+    'zindex': {'sheet': 'KESE Index', 'prefix': 'zindex_', 'exclude': [], 'demographics': False}
+}
+
+
+def _indicator_sheet(workbook, spec):
+    """Select and rename the name, demographic, and year columns of an indicator sheet in a single projection."""
+    df = workbook_load(workbook)[spec['sheet']]
+    demographics = {'demtype': 'demographic-type', 'demographic': 'demographic'} \
+        if workbook == 'national' and spec['demographics'] else {}
+    years = {
+        col: col[len(spec['prefix']):] for col in df.columns
+        if col.startswith(spec['prefix']) and not any(x in col for x in spec['exclude'])
+    }
+    columns = {'sname': 'name', **demographics, **years}
+    return df[list(columns)].\
+        rename(columns=columns, copy=False).\
+        reindex(columns=['name', 'demographic-type', 'demographic'] + list(years.values()))
+
+
+def website_data_create(indicator):
+    """
+    Create the website file of an indicator from the state and national workbooks, following its entry
+    in indicator_specs.
+
+    Parameters
+    ----------
+    indicator : str
+        The indicator. Options: the keys of indicator_specs
+
+    Returns
+    -------
+    DataFrame
+        The website data of the indicator
+    """
+    spec = indicator_specs[indicator]
+    df = pd.concat([_indicator_sheet('national', spec), _indicator_sheet('state', spec)]).\
+        astype({'demographic-type': 'object', 'demographic': 'object'}).\
+        assign(name=lambda x: x['name'].map(c.us_state_abbrev).map(c.state_abb_fips_dic)).\
+        rename(columns={'name': 'region'}).\
+        sort_values(by=['demographic-type']).\
+        reset_index(drop=True)
+    df.to_csv(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_kese_website_{indicator}.csv', index=False)
+    return df
+
 
 def ind_data_download_create(df, name):
     # rename columns
@@ -176,31 +129,36 @@ def ind_data_download_create(df, name):
     return df
 
 
+def data_download(frames):
+    """
+    Combine the long-format data of each indicator into the data download, with one concat and unstack.
+    The rows are those of the first indicator, as with a chain of left merges.
 
-def data_download(rne, ose, sjc, ssr, index):
-    rneose = pd.merge(rne, ose, how='left', on=['fips', 'name', 'type', 'category', 'year']).reset_index(drop=True)
-    sjcssr = pd.merge(sjc, ssr, how='left', on=['fips', 'name', 'type', 'category', 'year']).reset_index(drop=True)
-    rneosesjcssr = pd.merge(rneose, sjcssr, how='left', on=['fips', 'name', 'type', 'category', 'year']).reset_index(drop=True)
-    download = pd.merge(rneosesjcssr, index, how='left', on=['fips', 'name', 'type', 'category', 'year']).reset_index(drop=True)
-    download = download.sort_values(by=['name', 'year']).reset_index(drop=True)
-    print(download.head())
+    Parameters
+    ----------
+    frames : dict
+        The data of each indicator from ind_data_download_create, keyed by indicator
+
+    Returns
+    -------
+    DataFrame
+        The data download
+    """
+    keys = ['fips', 'name', 'type', 'category', 'year']
+    rows = pd.MultiIndex.from_frame(next(iter(frames.values()))[keys])
+    download = pd.concat({name: df.set_index(keys)[name] for name, df in frames.items()}, names=['indicator']).\
+        unstack('indicator').\
+        reindex(index=rows, columns=list(frames)).\
+        reset_index().\
+        rename_axis(columns=None).\
+        sort_values(by=['name', 'year']).\
+        reset_index(drop=True)
     download.to_csv(f's3://emkf.data.research/indicators/kese/data_outputs/2021_kese_website/2021_kese_download.csv', index=False)
     return download
 
 
 if __name__ == '__main__':
     # website files
-    rne = rne_data_create()
-    ose = ose_data_create()
-    sjc = sjc_data_create()
-    ssr = ssr_data_create()
-    index = index_data_create()
-    # individual data download files
-    rne = ind_data_download_create(rne, 'rne')
-    ose = ind_data_download_create(ose, 'ose')
-    sjc = ind_data_download_create(sjc, 'sjc')
-    ssr = ind_data_download_create(ssr, 'ssr')
-    index = ind_data_download_create(index, 'zindex')
-    # data download
-    download = data_download(rne, ose, sjc, ssr, index)
-
+    website = {indicator: website_data_create(indicator) for indicator in indicator_specs}
+    # individual data download files, and data download
+    download = data_download({name: ind_data_download_create(df, name) for name, df in website.items()})
@@ -0,0 +1,19 @@
+import os
+import sys
+import pytest
+
+# The tools are imported as the package tools, from the root of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tools.kese_helpers as h
+import tools.kese_cache as kc
+import tools.kese_profile as kp
+
+
+@pytest.fixture
+def temp_store(tmp_path, monkeypatch):
+    """Point the Parquet store and the run report at tmp_path, with the stage cache disabled."""
+    monkeypatch.setitem(h.settings, 'temp_dir', str(tmp_path / 'temp'))
+    monkeypatch.setitem(kc.settings, 'enabled', False)
+    monkeypatch.setitem(kp.settings, 'report_path', str(tmp_path / 'reports' / 'kese_run_report'))
+    return tmp_path
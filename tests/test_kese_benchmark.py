@@ -0,0 +1,36 @@
+import pandas as pd
+import pytest
+import tools.kese_benchmark as kb
+import tools.kese_command as kese
+
+
+@pytest.fixture
+def merged_state(temp_store):
+    """The merged state-level raw data in data/raw_data."""
+    kese._raw_data_fetch(False, ['us', 'state'])
+    return kese._raw_data_merge('state')
+
+
+def test_indicators_create_leaves_its_input_unchanged(merged_state):
+    before = merged_state.copy()
+    kese._indicators_create(merged_state, 'state')
+    pd.testing.assert_frame_equal(merged_state, before)
+
+
+def test_timed_memory_run_does_not_change_the_stage(merged_state):
+    expected = kese._indicators_create(merged_state.copy(), 'state')
+    results = []
+    out = kb._timed(results, '_indicators_create_state', kese._indicators_create, merged_state, 'state', memory=True)
+    pd.testing.assert_frame_equal(out, expected)
+    assert results[0]['rows_out'] == len(expected) and results[0]['peak_traced_mb'] is not None
+
+
+def test_benchmark_runs_with_a_county_level(tmp_path):
+    output = tmp_path / 'benchmark.jsonl'
+    results = kb.benchmark_run(micro_rows=2000, output=str(output), memory=False, counties=2)
+
+    rows = {stage['stage']: stage['rows_out'] for stage in results['stages']}
+    assert results['counties'] == 2
+    assert rows['_raw_data_merge_county'] == 2 * 51 * 26  # two counties per state and DC, 1996 - 2021
+    assert rows['_index_create_county'] == rows['_raw_data_merge_county']
+    assert output.read_text().count('\n') == 1
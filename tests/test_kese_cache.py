@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+import tools.kese_cache as kc
+import tools.kese_command as kese
+from tools.kese_cache import stage_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Enable the stage cache in tmp_path."""
+    monkeypatch.setitem(kc.settings, 'enabled', True)
+    monkeypatch.setitem(kc.settings, 'cache_dir', str(tmp_path / 'stages'))
+    return tmp_path / 'stages'
+
+
+def test_positional_and_keyword_calls_share_an_entry(cache_dir):
+    calls = []
+    columns = ['a', 'b']
+
+    @stage_cache(inputs=lambda region, scale=1: [], code=[columns])
+    def _stage(region, scale=1):
+        calls.append((region, scale))
+        return pd.DataFrame({'region': [region], 'scale': [scale]})
+
+    first = _stage('us')
+    pd.testing.assert_frame_equal(_stage(region='us'), first)
+    pd.testing.assert_frame_equal(_stage('us', scale=1), first)
+    assert calls == [('us', 1)]
+
+    # A value listed in code is part of the key
+    columns.append('c')
+    _stage('us')
+    assert calls == [('us', 1), ('us', 1)]
+    assert len(list(cache_dir.glob('*.pkl'))) == 2
+
+
+def test_raw_data_inputs_bind_by_name():
+    inputs = kese._raw_data_files('bed_table1_{region}')
+    assert inputs(region='state', fetch_data=False) == inputs(fetch_data=False, region='state')
+    assert inputs(region='state', fetch_data=False)[0].endswith('data/raw_data/bed_table1_state.csv')
+    assert inputs(region='state', fetch_data=True) is None
+
+
+def test_fetch_stage_keyword_call_is_cached(cache_dir):
+    df_t1, df_t7 = kese._fetch_data_bed('state', False)
+    df_t1_keyword, df_t7_keyword = kese._fetch_data_bed(region='state', fetch_data=False)
+    pd.testing.assert_frame_equal(df_t1, df_t1_keyword)
+    pd.testing.assert_frame_equal(df_t7, df_t7_keyword)
+    assert len(list(cache_dir.glob('_fetch_data_bed_*.pkl'))) == 1
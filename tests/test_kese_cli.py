@@ -0,0 +1,31 @@
+import json
+import subprocess
+import sys
+import pytest
+import tools.constants as c
+from tools.kese_cli import main
+
+probe = 'import sys, time, json; start = time.perf_counter(); import {module}; ' \
+    'print(json.dumps({{"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}}))'
+
+
+def _import(module):
+    """Import module in a fresh interpreter, from the root of the repository."""
+    run = subprocess.run(
+        [sys.executable, '-c', probe.format(module=module)], cwd=c.filenamer(''), capture_output=True, text=True
+    )
+    assert run.returncode == 0, run.stderr
+    return json.loads(run.stdout)
+
+
+@pytest.mark.parametrize('module', list(c.import_budgets))
+def test_import_is_lazy_and_within_budget(module):
+    runs = [_import(module) for _ in range(3)]
+    lazy = {name for name in runs[0]['modules'] if name.split('.')[0] in c.import_lazy_modules}
+    assert not lazy
+    assert min(run['seconds'] for run in runs) <= c.import_budgets[module]
+
+
+def test_parser_requires_a_subcommand():
+    with pytest.raises(SystemExit):
+        main([])
@@ -0,0 +1,292 @@
+import os
+import gzip
+import hashlib
+import functools
+import threading
+import urllib.error
+import numpy as np
+import pandas as pd
+import pytest
+import tools.constants as c
+import tools.kese_helpers as h
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from tools.kese_benchmark import synthetic_cps_microdata
+
+years = [2020, 2021]
+
+
+def _reference_preprocess_cps(df, region):
+    """The per-category query and groupby.apply implementation that preprocess_cps replaced."""
+    df = df.query('yeart1 == yeart1')
+
+    def _mean(col):
+        return lambda x: (x[col] * x['wgtat1']).sum() / x['wgtat1'].sum()
+
+    def _indicators(df, keys):
+        return df[df['ent015ua'].notna()].groupby(keys).apply(_mean('ent015ua')).reset_index(name='rne').\
+            merge(df[df['oppshare'].notna()].groupby(keys).apply(_mean('oppshare')).reset_index(name='ose'))
+
+    if region == 'state':
+        df_processed = _indicators(df, ['yeart1', 'state']).\
+            assign(
+                category='Total',
+                type='Total',
+                fips=lambda x: x['state'].map(c.cps_to_fips),
+                region=lambda x: x['fips'].map(c.state_fips_abb_dic).map(c.abbrev_us_state)
+            )
+    else:
+        df_processed = pd.concat(
+            [
+                _indicators(df.query(c.kese_category_queries[cat]), ['yeart1']).\
+                    assign(type=type_c, category=cat, fips='00', region='United States')
+                for type_c in c.kese_categories for cat in c.kese_categories[type_c]
+            ]
+        )
+    return df_processed.\
+        rename(columns={'yeart1': 'time'}).\
+        astype({'time': 'int'}).\
+        reset_index(drop=True) \
+        [['fips', 'region', 'type', 'category', 'time', 'rne', 'ose']]
+
+
+@pytest.fixture(scope='module')
+def cps_microdata():
+    """Synthetic CPS microdata of three years and four states, with missing years, weights, and indicators."""
+    df = pd.concat([synthetic_cps_microdata(3000, year) for year in [2019, 2020, 2021]], ignore_index=True)
+    rng = np.random.default_rng(0)
+    df['state'] = rng.choice(list(c.cps_states_dic)[:4], len(df))
+    df['oppshare'] = np.where(rng.random(len(df)) < .7, np.nan, rng.random(len(df)) < .8)
+    df.loc[rng.random(len(df)) < .05, 'wgtat1'] = np.nan
+    df.loc[rng.random(len(df)) < .01, 'yeart1'] = np.nan
+    return df
+
+
+@pytest.mark.parametrize('region', ['us', 'state'])
+def test_preprocess_cps_matches_the_reference(cps_microdata, region):
+    expected = _reference_preprocess_cps(cps_microdata, region)
+    assert expected['fips' if region == 'state' else 'category'].nunique() > 1 and expected['time'].nunique() == 3
+    # The sums are added up in a different order, which moves the means by about 1 ulp
+    pd.testing.assert_frame_equal(
+        h.preprocess_cps(cps_microdata, region), expected, check_exact=False, rtol=1e-14, atol=0
+    )
+
+
+def test_preprocess_cps_chunks_matches_the_reference(cps_microdata):
+    df_us, df_state = h.preprocess_cps_chunks(np.array_split(cps_microdata, 4))
+    pd.testing.assert_frame_equal(df_us, _reference_preprocess_cps(cps_microdata, 'us'), check_exact=False, rtol=1e-14)
+    pd.testing.assert_frame_equal(
+        df_state, _reference_preprocess_cps(cps_microdata, 'state'), check_exact=False, rtol=1e-14
+    )
+
+
+@pytest.fixture
+def cps_server(tmp_path):
+    """Serve fixture CPS microdata files over HTTP on a free local port, recording the status of each response."""
+    directory = tmp_path / 'server'
+    directory.mkdir()
+    for year in years:
+        synthetic_cps_microdata(2000, year).to_csv(directory / f'kieadata{year}.csv', index=False)
+
+    statuses = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def send_response(self, code, message=None):
+            statuses.append(code)
+            super().send_response(code, message)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=str(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/kieadata{{year}}.csv', directory, statuses
+    server.shutdown()
+    server.server_close()
+
+
+def test_cps_fetch_matches_local_preprocessing(cps_server, tmp_path):
+    url, directory, statuses = cps_server
+    df_us, df_state = h.cps_fetch(years, url, cache_dir=str(tmp_path / 'cache'), max_workers=2)
+
+    expected = [
+        h.preprocess_cps_chunks(h.read_cps(str(directory / f'kieadata{year}.csv')), seed=[c.cps_replicate_seed, year])
+        for year in years
+    ]
+    pd.testing.assert_frame_equal(df_us, pd.concat([us for us, _ in expected], ignore_index=True))
+    pd.testing.assert_frame_equal(df_state, pd.concat([state for _, state in expected], ignore_index=True))
+    assert statuses == [200, 200]
+
+
+def test_cps_fetch_revalidates_cached_downloads(cps_server, tmp_path):
+    url, directory, statuses = cps_server
+    cache_dir = str(tmp_path / 'cache')
+    first = h.cps_fetch(years, url, cache_dir=cache_dir, max_workers=2)
+    second = h.cps_fetch(years, url, cache_dir=cache_dir, max_workers=2)
+
+    # The second fetch is answered with 304 Not Modified and read from the cache
+    assert statuses == [200, 200, 304, 304]
+    assert len(os.listdir(os.path.join(cache_dir, 'objects'))) == len(years)
+    for df_first, df_second in zip(first, second):
+        pd.testing.assert_frame_equal(df_first, df_second)
+
+
+def test_cached_download_streams_in_chunks(cps_server, tmp_path, monkeypatch):
+    url, directory, statuses = cps_server
+    monkeypatch.setattr(c, 'download_chunksize', 1000)
+    cache_dir = tmp_path / 'cache'
+    path = h.cached_download(url.format(year=2021), str(cache_dir))
+
+    content = (directory / 'kieadata2021.csv').read_bytes()
+    assert len(content) > 10 * c.download_chunksize
+    assert os.path.basename(path) == hashlib.sha256(content).hexdigest()
+    with open(path, 'rb') as f:
+        assert f.read() == content
+
+    # A failed download leaves no temporary file behind
+    with pytest.raises(urllib.error.HTTPError):
+        h.cached_download(url.format(year=1999), str(cache_dir))
+    assert os.listdir(cache_dir / 'objects') == [os.path.basename(path)]
+
+
+def test_outputs_write_copies_are_identical(tmp_path):
+    fsspec = pytest.importorskip('fsspec')
+    df = pd.DataFrame({'fips': ['00', '06'], 'year': [2020, 2021], 'rne': [.0031, .0042]})
+    frames = {'kcr_calc_test_kese_download': df, 'kcr_calc_test_kese_website_rne': df[['fips', 'rne']]}
+    h.outputs_write(frames, 'memory://kese/outputs/', c.output_formats, directory=str(tmp_path))
+
+    fs = fsspec.filesystem('memory')
+    for name, frame in frames.items():
+        for fmt in c.output_formats:
+            local = (tmp_path / f'{name}.{fmt}').read_bytes()
+            assert fs.cat(f'/kese/outputs/{name}.{fmt}') == local
+
+        pd.testing.assert_frame_equal(pd.read_csv(tmp_path / f'{name}.csv', dtype={'fips': str}), frame)
+        pd.testing.assert_frame_equal(pd.read_parquet(tmp_path / f'{name}.parquet'), frame)
+        assert gzip.decompress((tmp_path / f'{name}.csv.gz').read_bytes()) == (tmp_path / f'{name}.csv').read_bytes()
+    fs.rm('/kese', recursive=True)
+
+
+def test_outputs_write_rejects_unknown_formats(tmp_path):
+    with pytest.raises(ValueError, match='Unknown output formats'):
+        h.outputs_write({'name': pd.DataFrame({'a': [1]})}, formats=['xlsx'], directory=str(tmp_path))
+
+
+def _join_frames():
+    """Frames keyed by (fips, time) in shuffled order, with keys missing from each side."""
+    df = pd.DataFrame({'fips': ['06', '01', '06', '36', '01', '48'], 'time': [2001, 2000, 2000, 2001, 2003, 2000]})
+    bed = pd.DataFrame(
+        {
+            'fips': ['36', '01', '06', '06', '01', '12'],
+            'time': [2001, 2003, 2000, 2001, 2000, 2000],
+            'establishments': pd.array([5, 4, 3, 2, 1, 9], dtype='Int32')
+        }
+    )
+    pop = pd.DataFrame({'fips': ['06', '01', '48'], 'time': [2001, 1999, 2000], 'population': [30., 4., 20.]})
+    return h.categorical_keys([df, bed, pop], 'fips')
+
+
+def test_keyed_join_matches_merge():
+    df, bed, pop = _join_frames()
+    expected = df.\
+        merge(bed, on=['fips', 'time'], how='left', validate='many_to_one').\
+        merge(pop, on=['fips', 'time'], how='left', validate='many_to_one')
+    actual = h.keyed_join(df, [bed, pop])
+    pd.testing.assert_frame_equal(actual, expected)
+    assert actual['establishments'].isna().sum() == 1 and actual['population'].isna().sum() == 4
+
+
+def test_keyed_join_rejects_duplicate_keys():
+    df, bed, pop = _join_frames()
+    with pytest.raises(ValueError, match=r'more than one row per \(fips, time\)'):
+        h.keyed_join(df, [pd.concat([bed, bed.iloc[[2]]], ignore_index=True)])
+    with pytest.raises(ValueError, match='more than one of the joined frames'):
+        h.keyed_join(df, [pop, pop])
+
+
+def test_rolling_mean_matches_pandas_rolling_on_contiguous_panels():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        [
+            (fips, category, year)
+            for fips in ['01', '06', '36'] for category in ['Total', 'Women'] for year in range(2000, 2010)
+        ],
+        columns=['fips', 'category', 'time']
+    ).assign(rne=lambda x: rng.random(len(x)), ose=lambda x: rng.random(len(x)))
+    df.loc[[3, 27], 'rne'] = np.nan
+    expected = df.groupby(['fips', 'category'])[['rne', 'ose']].transform(lambda x: x.rolling(window=3).mean())
+
+    # Rows in any order give the same means, aligned with the index
+    shuffled = df.sample(frac=1, random_state=0)
+    actual = h.rolling_mean(shuffled, ['fips', 'category'], ['rne', 'ose']).loc[df.index]
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False, rtol=1e-14)
+
+
+def test_rolling_mean_does_not_average_across_gaps():
+    df = pd.DataFrame({'fips': '06', 'time': [2000, 2001, 2003, 2004, 2005, 2006], 'rne': [1., 2., 4., 5., 6., 7.]})
+    means = h.rolling_mean(df, ['fips'], ['rne'])['rne']
+
+    # 2002 is missing, so the first complete window is 2003 - 2005; pandas' rolling(3) would average 2000,
+    # 2001, and 2003 in 2003
+    np.testing.assert_array_equal(means, [np.nan, np.nan, np.nan, np.nan, 5., 6.])
+    assert df['rne'].rolling(window=3).mean()[2] == pytest.approx(7 / 3)
+
+
+def _multipliers(n_rows, seed, replicates, blocksize):
+    """The Exp(1) multipliers of _replicate_sums, drawn a block of rows at a time as it draws them."""
+    rng = np.random.default_rng(seed)
+    return np.concatenate(
+        [
+            rng.standard_exponential((min(blocksize, n_rows - start), replicates), dtype=np.float32)
+            for start in range(0, n_rows, blocksize)
+        ]
+    ).astype('float64')
+
+
+@pytest.mark.parametrize('n_cells, share', [(3, .6), (400, .005)], ids=['dense', 'sparse'])
+def test_replicate_sums_match_a_loop_over_replicates(n_cells, share):
+    rng = np.random.default_rng(1)
+    n_rows, replicates, blocksize, seed = 500, 20, 128, [7, 2021]
+    # (row, cell) pairs of a membership matrix, as built by _weighted_sums
+    rows, cells = np.nonzero(rng.random((n_rows, n_cells)) < share)
+    terms = {'wx': rng.random(len(rows)) * 1000, 'w': rng.random(len(rows)) * 1000}
+
+    actual = h._replicate_sums(rows, cells, terms, n_rows, n_cells, seed, replicates, blocksize)
+    multipliers = _multipliers(n_rows, seed, replicates, blocksize)
+    for r in range(replicates):
+        for name, values in terms.items():
+            expected = np.bincount(cells, weights=values * multipliers[rows, r], minlength=n_cells)
+            # The products are taken in float32
+            np.testing.assert_allclose(actual[f'{name}_{r}'], expected, rtol=1e-5, err_msg=f'{name}_{r}')
+
+
+def test_replicate_se_match_a_loop_over_replicates(cps_microdata):
+    seed = [c.cps_replicate_seed, 2021]
+    actual = h.preprocess_cps(cps_microdata, 'state', seed)
+
+    df = cps_microdata[cps_microdata['yeart1'].notna()].reset_index(drop=True)
+    multipliers = _multipliers(len(df), seed, c.cps_replicates, c.cps_replicate_blocksize)
+    w = df['wgtat1'].fillna(0).to_numpy()
+    for indicator, col in [('rne', 'ent015ua'), ('ose', 'oppshare')]:
+        valid = df[col].notna().to_numpy()
+        means = []
+        for r in range(c.cps_replicates):
+            weighted = df[valid].assign(w=w[valid] * multipliers[valid, r], wx=lambda x: x['w'] * x[col])
+            sums = weighted.groupby(['yeart1', 'state'])[['wx', 'w']].sum()
+            means.append(sums['wx'] / sums['w'])
+        expected = pd.concat(means, axis=1).std(axis=1, ddof=1).\
+            rename(index=lambda state: c.cps_to_fips[state], level='state')
+        expected = expected.reindex(pd.MultiIndex.from_frame(actual[['time', 'fips']].astype({'time': float})))
+        np.testing.assert_allclose(actual[f'{indicator}_se'], expected, rtol=1e-5, err_msg=indicator)
+
+
+def test_rolling_se_matches_a_loop_over_windows():
+    rng = np.random.default_rng(2)
+    df = pd.DataFrame({'fips': np.repeat(['01', '06'], 6), 'time': np.tile(range(2000, 2006), 2)}).\
+        assign(rne_se=rng.random(12))
+    actual = h.rolling_se(df, ['fips'], ['rne_se'])['rne_se'].to_numpy()
+
+    expected = [
+        np.sqrt(sum(df['rne_se'][i - lag] ** 2 for lag in range(3))) / 3 if i % 6 >= 2 else np.nan
+        for i in range(len(df))
+    ]
+    np.testing.assert_allclose(actual, expected, rtol=1e-14)
@@ -0,0 +1,88 @@
+import openpyxl
+import pandas as pd
+import pytest
+import tools.constants as c
+import tools.kese_pep as kpep
+
+regions = ['us', 'state']
+
+
+@pytest.fixture(scope='module')
+def raw():
+    """The population estimates in data/raw_data, typed as pep_load returns them."""
+    return {
+        region: pd.read_csv(c.filenamer(f'data/raw_data/pep_{region}.csv'), dtype={'fips': 'str'}).\
+            astype(kpep.columns)
+        for region in regions
+    }
+
+
+@pytest.fixture
+def statab(tmp_path, raw):
+    """A spreadsheet in the layout of the Statistical Abstract table, with the 1996 - 1999 raw data."""
+    years = range(1996, 2000)
+    thousands = {
+        region: df[df['time'].isin(years)].pivot(index='region', columns='time', values='population') / 1000
+        for region, df in raw.items()
+    }
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for row in [['Table 13. State Population'], [None], [None], ['State'] + [f'{year} (July)' for year in years]]:
+        ws.append(row)
+    ws.append(['  United States '] + thousands['us'].loc['United States'].tolist())
+    ws.append(['Northeast'] + [1.0] * len(years))
+    for name, values in thousands['state'].iterrows():
+        ws.append([name] + values.tolist())
+    ws.append(['West '] + [1.0] * len(years))
+    for i in range(9):
+        ws.append([f'Footnote {i}'])
+    path = tmp_path / 'statab.xlsx'
+    wb.save(path)
+    return path
+
+
+def _sources(raw, statab, parse=kpep._statab_parse):
+    """The sources registry, with the Census API replaced by the raw data and the table by the fixture."""
+    return [
+        {**kpep.sources[0], 'fetch': lambda region, years: raw[region].query('time >= @years[0]')},
+        {**kpep.sources[1], 'urls': {region: f'file://{statab}' for region in regions}, 'parse': parse}
+    ]
+
+
+@pytest.mark.parametrize('region', regions)
+def test_pep_load_matches_raw_data(tmp_path, raw, statab, region):
+    df = kpep.pep_load(region, _sources(raw, statab), cache_dir=str(tmp_path / 'cache'))
+    pd.testing.assert_frame_equal(df, raw[region], check_exact=False, rtol=1e-12)
+
+
+def test_pep_keeps_the_years_from_2000(tmp_path, raw, statab):
+    # The Census API values are not replaced by any other source
+    df = kpep.pep_load('us', _sources(raw, statab), cache_dir=str(tmp_path / 'cache'))
+    assert df.query('time == 2020')['population'].item() == 329484123
+
+
+def test_parser_change_invalidates_the_parsed_cache(tmp_path, raw, statab):
+    calls = []
+
+    def parse(path, region, years):
+        calls.append(region)
+        return kpep._statab_parse(path, region, years)
+
+    def parse_edited(path, region, years):
+        calls.append(f'{region} edited')
+        return kpep._statab_parse(path, region, years)
+
+    cache_dir = str(tmp_path / 'cache')
+    first = kpep.pep_load('us', _sources(raw, statab, parse), cache_dir=cache_dir)
+    kpep.pep_load('us', _sources(raw, statab, parse), cache_dir=cache_dir)
+    assert calls == ['us']
+
+    pd.testing.assert_frame_equal(kpep.pep_load('us', _sources(raw, statab, parse_edited), cache_dir=cache_dir), first)
+    assert calls == ['us', 'us edited']
+
+
+def test_overlapping_sources_raise(tmp_path, raw, statab):
+    sources = _sources(raw, statab)
+    sources.append({**sources[1], 'name': 'statab_again'})
+    with pytest.raises(ValueError, match='Duplicate population estimates'):
+        kpep.pep_load('us', sources, cache_dir=str(tmp_path / 'cache'))
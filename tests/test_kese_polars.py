@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+import tools.kese_command as kese
+
+pytest.importorskip('polars')
+from tools.kese_polars import polars_pipeline  # noqa: E402
+
+regions = ['us', 'state']
+keys = ['fips', 'name', 'type', 'category', 'year']
+# The relative tolerances documented in kese_polars.polars_pipeline
+rtols = {'rne': 1e-13, 'ose': 1e-13, 'sjc': 1e-13, 'ssr': 1e-13, 'zindex': 2e-12}
+
+
+@pytest.fixture
+def backends(temp_store):
+    """The outputs of the pandas and polars backends on the bundled raw data."""
+    df_pandas = kese._pipeline(False, regions).reset_index(drop=True)
+    df_polars = polars_pipeline(regions)
+    return df_pandas, df_polars
+
+
+def test_polars_matches_pandas_row_for_row(backends):
+    df_pandas, df_polars = backends
+    assert list(df_polars.columns) == list(df_pandas.columns)
+    assert len(df_polars) == len(df_pandas)
+    pd.testing.assert_frame_equal(
+        df_polars[keys].astype(str), df_pandas[keys].astype(str), check_dtype=False
+    )
+
+
+def test_polars_values_within_documented_tolerance(backends):
+    df_pandas, df_polars = backends
+    for col, rtol in rtols.items():
+        expected = df_pandas[col].to_numpy('float64')
+        actual = df_polars[col].to_numpy('float64')
+        np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected), err_msg=col)
+        np.testing.assert_allclose(actual, expected, rtol=rtol, err_msg=col)
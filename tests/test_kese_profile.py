@@ -0,0 +1,25 @@
+import time
+import tools.kese_helpers as h
+import tools.kese_profile as kp
+
+
+def test_tasks_on_the_pool_are_nested_in_dag_run(temp_store):
+    @kp.instrument
+    def _task(results):
+        time.sleep(0.05)
+        return len(results)
+
+    kp.run_start()
+    h.dag_run({'a': (_task, []), 'b': (_task, []), 'c': (_task, ['a', 'b'])}, max_workers=2)
+    calls = {call['stage']: call for call in kp._calls if call['stage'] in ('dag_run', '_task')}
+
+    assert [call['parent'] for call in kp._calls if call['stage'] == '_task'] == ['dag_run'] * 3
+    # The tasks account for the time of dag_run, which only schedules them
+    assert calls['dag_run']['self_seconds'] < 0.05
+    assert 'peak_rss_mb' not in calls['dag_run']
+
+
+def test_only_the_listed_functions_are_instrumented():
+    assert getattr(h.temp_save, '_instrumented', False)
+    assert not getattr(h.temp_path, '_instrumented', False)
+    assert not getattr(h._encoded_key, '_instrumented', False)
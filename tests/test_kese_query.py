@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import threading
+import http.client
+import numpy as np
+import pandas as pd
+import pytest
+import tools.kese_query as kq
+
+
+def _download(rne=.003):
+    """A small download-version of the data: two states and the US by sex, in two years."""
+    rows = [
+        (fips, name, type_, category, year)
+        for fips, name, demographics in [
+            ('00', 'United States', [('Total', 'Total'), ('Sex', 'Men'), ('Sex', 'Women')]),
+            ('01', 'Alabama', [('Total', 'Total')]),
+            ('06', 'California', [('Total', 'Total')])
+        ]
+        for type_, category in demographics for year in [2021, 2020]
+    ]
+    return pd.DataFrame(rows, columns=['fips', 'name', 'type', 'category', 'year']).\
+        assign(rne=rne, ose=.8, sjc=1.5, ssr=.7, zindex=np.nan)
+
+
+def _write(df, path):
+    """Replace the data at path atomically, as _outputs_save does."""
+    df.to_csv(f'{path}.tmp', index=False)
+    os.replace(f'{path}.tmp', path)
+
+
+@pytest.fixture
+def download(tmp_path, monkeypatch):
+    """The download-version of the data in tmp_path, as the data the query API reads."""
+    path = str(tmp_path / 'kese_download.csv')
+    _write(_download(), path)
+    monkeypatch.setitem(kq.settings, 'path', path)
+    monkeypatch.setitem(kq.settings, 'poll_seconds', .01)
+    monkeypatch.setitem(kq._state, 'index', None)
+    return path
+
+
+def _wait(condition, seconds=5):
+    """Wait until condition() is true, failing after seconds."""
+    deadline = time.monotonic() + seconds
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(.01)
+
+
+def test_index_build():
+    index = kq._index_build(_download())
+    assert index['rows'] == 10
+    groups = [
+        ('00', 'Total', 'Total'), ('00', 'Sex', 'Men'), ('00', 'Sex', 'Women'), ('01', 'Total', 'Total'),
+        ('06', 'Total', 'Total')
+    ]
+    assert set(index['cells']) == {group + (year,) for group in groups for year in [2020, 2021]}
+    # Series are sorted by year and cross-sections by fips, and missing values are None
+    assert [record['year'] for record in index['series'][('06', 'Total', 'Total')]] == [2020, 2021]
+    assert [record['fips'] for record in index['years'][('Total', 'Total', 2020)]] == ['00', '01', '06']
+    assert index['cells'][('01', 'Total', 'Total', 2020)]['zindex'] is None
+
+
+def test_queries(download):
+    assert kq.cell('06', 'Total', 'Total', 2021)['name'] == 'California'
+    assert kq.cell('06', 'Total', 'Total', 1999) is None
+    assert [record['year'] for record in kq.series('01')] == [2020, 2021]
+    assert kq.series('99') == []
+    assert [record['fips'] for record in kq.year(2021)] == ['00', '01', '06']
+    assert [record['category'] for record in kq.demographic('Sex', 'Women')] == ['Women', 'Women']
+    assert kq.info()['rows'] == 10
+
+
+def test_reload_on_file_change(download):
+    stop = threading.Event()
+    thread = kq.watch(download, stop=stop)
+    try:
+        assert kq.cell('06', 'Total', 'Total', 2021)['rne'] == .003
+        _write(_download(rne=.004).iloc[2:], download)
+        _wait(lambda: kq.info()['rows'] == 8)
+        assert kq.cell('06', 'Total', 'Total', 2021)['rne'] == .004
+        assert kq.reload(download) is False
+    finally:
+        stop.set()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def _get(port, target):
+    """GET target from the server, returning the status and the decoded JSON body."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', target)
+    response = conn.getresponse()
+    body = json.loads(response.read())
+    conn.close()
+    return response.status, body
+
+
+def test_serve(download):
+    server = kq.serve(port=0, path=download)
+    try:
+        status, body = _get(server.server_port, '/series?fips=06')
+        assert status == 200 and [record['year'] for record in body] == [2020, 2021]
+        status, body = _get(server.server_port, '/cell?fips=00&type=Sex&category=Men&year=2020')
+        assert status == 200 and body['category'] == 'Men' and body['zindex'] is None
+
+        assert _get(server.server_port, '/unknown')[0] == 404
+        assert _get(server.server_port, '/year?year=twenty')[0] == 400
+        assert _get(server.server_port, '/series?fips=06&color=red')[0] == 400
+        assert _get(server.server_port, '/cell?fips=06')[0] == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Shutting the server down also stops its watcher
+    assert server.watch_stop.is_set()
+    _wait(lambda: not any(thread.name == 'kese_query_watch' for thread in threading.enumerate()))
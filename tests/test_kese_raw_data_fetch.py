@@ -0,0 +1,62 @@
+import os
+import pytest
+import tools.constants as c
+import tools.kese_raw_data_fetch as rdf
+
+moto = pytest.importorskip('moto')
+bucket = 'kese-test'
+prefix = 'indicators/kese/raw_data'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """An S3 client of a moto mock of S3 with an empty bucket."""
+    import boto3
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=bucket)
+        yield client
+
+
+def _plan(df_plan):
+    return dict(zip(df_plan['key'], zip(df_plan['action'], df_plan['reason'])))
+
+
+def test_s3_sync_uploads_only_changed_files(s3, tmp_path):
+    files = []
+    for name, content in [('cps_us.csv', b'fips,time\n00,2021\n'), ('pep_us.csv', b'fips,population\n00,1\n')]:
+        (tmp_path / name).write_bytes(content)
+        files.append(str(tmp_path / name))
+
+    assert _plan(rdf.s3_sync(files, bucket, prefix, client=s3)) == {
+        f'{prefix}/cps_us.csv': ('upload', 'new'), f'{prefix}/pep_us.csv': ('upload', 'new')
+    }
+    assert s3.get_object(Bucket=bucket, Key=f'{prefix}/cps_us.csv')['Body'].read() == b'fips,time\n00,2021\n'
+
+    (tmp_path / 'pep_us.csv').write_bytes(b'fips,population\n00,2\n')
+    assert _plan(rdf.s3_sync(files, bucket, prefix, client=s3)) == {
+        f'{prefix}/cps_us.csv': ('skip', 'unchanged'), f'{prefix}/pep_us.csv': ('upload', 'content changed')
+    }
+
+    # A dry run plans the upload without making it
+    (tmp_path / 'cps_us.csv').write_bytes(b'fips,time\n00,2021\n00,2022\n')
+    assert _plan(rdf.s3_sync(files, bucket, prefix, dry_run=True, client=s3))[f'{prefix}/cps_us.csv'] == \
+        ('upload', 'size changed')
+    assert s3.get_object(Bucket=bucket, Key=f'{prefix}/cps_us.csv')['Body'].read() == b'fips,time\n00,2021\n'
+
+
+def test_s3_sync_skips_unchanged_multipart_uploads(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(c, 's3_multipart_threshold', 5 * 1024 ** 2)
+    monkeypatch.setattr(c, 's3_multipart_chunksize', 5 * 1024 ** 2)
+    path = tmp_path / 'cps_state.csv'
+    path.write_bytes(os.urandom(6 * 1024 ** 2))
+
+    rdf.s3_sync([str(path)], bucket, prefix, client=s3)
+    # The ETag of a multipart upload is not an MD5, so the MD5 in the metadata is compared instead
+    assert '-' in s3.head_object(Bucket=bucket, Key=f'{prefix}/cps_state.csv')['ETag']
+    assert _plan(rdf.s3_sync([str(path)], bucket, prefix, client=s3)) == {
+        f'{prefix}/cps_state.csv': ('skip', 'unchanged')
+    }
@@ -0,0 +1,57 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import tools.constants as c
+import tools.kese_schema as ks
+
+files = sorted(glob.glob(c.filenamer('data/raw_data/*.csv'))) + \
+    sorted(glob.glob(c.filenamer('data/kcr_calc_*_kese_download.csv')))
+
+
+def _region(path):
+    """Return the geographical level of a file, from the suffix of its name. The download has 2-digit fips codes."""
+    name = os.path.basename(path)[:-len('.csv')]
+    return name.rsplit('_', 1)[-1] if name.rsplit('_', 1)[-1] in c.geographies else 'state'
+
+
+@pytest.mark.parametrize('path', files, ids=os.path.basename)
+def test_schema_apply_preserves_values(path):
+    df = pd.read_csv(path)
+    region = _region(path)
+    typed = ks.schema_apply(df, region)
+
+    for col in df.columns:
+        dtype = ks.dtypes.get(col)
+        if dtype is None:
+            continue
+        if dtype == 'category':
+            expected = df[col].astype(str)
+            if col == 'fips':
+                expected = expected.str.zfill(c.geographies[region]['fips_width'])
+            assert (typed[col].astype(str) == expected).all(), col
+        elif dtype == 'float32':
+            # Published with at most two decimals, which float32 holds to within its ~6e-8 relative error,
+            # so rounding to two decimals recovers the published values exactly
+            actual = typed[col].to_numpy('float64')
+            np.testing.assert_allclose(actual, df[col], rtol=6e-8, err_msg=col)
+            np.testing.assert_array_equal(np.round(actual, 2), df[col], err_msg=col)
+        elif col == 'population':
+            # Rounded, which only removes the float artifacts of estimates published in thousands
+            actual = typed[col].to_numpy('float64', na_value=np.nan)
+            np.testing.assert_allclose(actual, df[col], rtol=1e-15, err_msg=col)
+            np.testing.assert_array_equal(actual, df[col].round(), err_msg=col)
+        else:
+            # Integers and float64 are exact
+            np.testing.assert_array_equal(typed[col].to_numpy('float64', na_value=np.nan), df[col], err_msg=col)
+
+
+def test_indicators_are_not_float32_safe():
+    # Why RNE, OSE, and the indicators derived from them stay float64: a float32 round trip changes the
+    # published values
+    df = pd.read_csv(c.filenamer(f'data/kcr_calc_{c.vintage}_kese_download.csv'))
+    for col in ['rne', 'ose', 'zindex']:
+        assert ks.dtypes[col] == 'float64'
+        values = df[col].dropna().to_numpy()
+        assert (values.astype('float32').astype('float64') != values).any(), col
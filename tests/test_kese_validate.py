@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+import tools.kese_command as kese
+import tools.kese_validate as kv
+
+
+@pytest.fixture
+def merged():
+    """Clean merged state-level data of two states in 2000 - 2004."""
+    years = list(range(2000, 2005))
+    return pd.DataFrame(
+        {
+            'fips': np.repeat(['01', '06'], len(years)),
+            'region': np.repeat(['Alabama', 'California'], len(years)),
+            'type': 'Total',
+            'category': 'Total',
+            'time': years * 2,
+            'rne': .003,
+            'ose': .8,
+            'opening_job_gains': 20000.,
+            'establishments': 8000.,
+            'Lestablishments': 9000.,
+            'population': 4e6
+        }
+    )
+
+
+def _failures(report, check, column=None):
+    """The number of failing rows and the examples of a check, and of a column if given."""
+    rows = report[(report['check'] == check) & ((report['column'] == column) if column else True)]
+    return rows['failures'].sum(), [example for examples in rows['examples'] for example in examples]
+
+
+def test_clean_data_passes(merged):
+    assert kv.merged_validate(merged, 'state')['failures'].sum() == 0
+
+
+def test_bundled_data_has_no_errors(temp_store):
+    kese._raw_data_fetch(False, ['us', 'state'])
+    for region in ['us', 'state']:
+        report = kv.merged_validate(kese._raw_data_merge(region), region)
+        assert report.query('severity == "error"')['failures'].sum() == 0, kv.report_text(report, region)
+
+
+def test_duplicate_keys(merged):
+    df = pd.concat([merged, merged.iloc[[6]]], ignore_index=True)
+    assert _failures(kv.merged_validate(df, 'state'), 'keys') == (1, ['06/Total/Total/2001'])
+    # A duplicate does not make its group incomplete
+    assert _failures(kv.merged_validate(df, 'state'), 'panel')[0] == 0
+
+
+def test_panel_gap(merged):
+    failures, examples = _failures(kv.merged_validate(merged.drop(index=7), 'state'), 'panel')
+    assert failures == 4 and examples[0].startswith('06/')
+
+
+def test_missing_values(merged):
+    merged.loc[2, 'rne'] = np.nan
+    merged.loc[8, 'population'] = np.nan
+    report = kv.merged_validate(merged, 'state')
+    assert _failures(report, 'missing', 'rne') == (1, ['01/Total/Total/2002'])
+    assert _failures(report, 'missing', 'population') == (1, ['06/Total/Total/2003'])
+    assert _failures(report, 'missing', 'ose')[0] == 0
+
+
+def test_missing_rne_is_allowed_without_the_cps(merged):
+    report = kv.merged_validate(merged.assign(fips=merged['fips'] + '001', rne=np.nan, ose=np.nan), 'county')
+    assert _failures(report, 'missing')[0] == 0
+
+
+def test_out_of_range_values(merged):
+    merged.loc[1, 'ose'] = 1.2
+    merged.loc[5, 'Lestablishments'] = 0
+    merged.loc[6, 'opening_job_gains'] = -1
+    report = kv.merged_validate(merged, 'state')
+    assert _failures(report, 'range', 'ose') == (1, ['01/Total/Total/2001'])
+    assert _failures(report, 'range', 'Lestablishments') == (1, ['06/Total/Total/2000'])
+    assert _failures(report, 'range', 'opening_job_gains') == (1, ['06/Total/Total/2001'])
+
+
+def test_jumps_are_warnings(merged):
+    merged.loc[merged['time'] >= 2003, 'population'] = 5e6
+    merged.loc[merged['fips'] == '06', 'establishments'] = 80000.
+    report = kv.merged_validate(merged, 'state')
+    assert _failures(report, 'jump', 'population') == (2, ['01/Total/Total/2003', '06/Total/Total/2003'])
+    assert report.query('check == "jump"')['severity'].eq('warning').all()
+    # Consecutive rows of different states are not consecutive years
+    assert _failures(report, 'jump', 'establishments')[0] == 0
+
+
+def test_errors_stop_the_run(merged, monkeypatch):
+    monkeypatch.setitem(kv.settings, 'on_error', 'raise')
+    with pytest.raises(ValueError):
+        kese._merged_validate(merged.drop(index=7), 'state')
+    monkeypatch.setitem(kv.settings, 'on_error', 'warn')
+    pd.testing.assert_frame_equal(kese._merged_validate(merged.drop(index=7), 'state'), merged.drop(index=7))
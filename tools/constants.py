@@ -177,6 +177,81 @@ lfs_series_dict = {
 
 
 
+# Geographical levels of the data. fips_width is the number of digits of the fips codes; cps marks the
+# levels covered by the CPS microdata (RNE and OSE); pep_pre_2000 marks the levels covered by the
+# 1996 - 1999 population table.
+geographies = {
+    'us': {'fips_width': 2, 'cps': True, 'pep_pre_2000': True},
+    'state': {'fips_width': 2, 'cps': True, 'pep_pre_2000': True},
+    'county': {'fips_width': 5, 'cps': False, 'pep_pre_2000': False},
+    'msa': {'fips_width': 5, 'cps': False, 'pep_pre_2000': False},
+}
+
+cps_microdata_url = 'https://people.ucsc.edu/~rfairlie/data/microdata/kieadata{year}.csv'
+cps_years = range(1996, 2022)
+cps_fetch_workers = 8
+cps_chunksize = 250000
+download_chunksize = 1024 ** 2  # bytes of a download held in memory at once
+pep_fetch_workers = 4
+
+# Columns of the CPS microdata used by the indicators. The category and key columns are small integer
+# codes, which float32 holds exactly while allowing for missing values; the outcomes and weights are
+# kept at full precision since they enter the weighted sums.
+cps_dtypes = {
+    'yeart1': 'float32', 'state': 'float32', 'age': 'float32', 'grdatn': 'float32', 'immigr': 'float32',
+    'race': 'float32', 'spneth': 'float32', 'female': 'float32', 'vet': 'float32',
+    'ent015ua': 'float64', 'oppshare': 'float64', 'wgtat1': 'float64'
+}
+
+# Bootstrap standard errors of RNE and OSE: the number of replicate weights, the seed from which they
+# are drawn, and the number of microdata rows whose replicate weights are held in memory at once
+cps_replicates = 200
+cps_replicate_seed = 2021
+cps_replicate_blocksize = 20000
+
+stage_cache_max_bytes = 2 * 1024 ** 3
+pipeline_workers = 6
+
+# Vintage of the raw data in data/raw_data, which tags the names of the output files, and the window of
+# years over which the index is standardized. The raw data of other vintages is kept in
+# data/raw_data/{vintage}.
+vintage = 2021
+index_baseline = (1996, 2015)
+
+# Validation of the merged raw data: the allowed range of each column, as (low, high, (low included,
+# high included)), and the largest ratio between consecutive years of each column before it is flagged
+# as a jump. The BED counts of small states swing by more than 2x from year to year.
+validation_ranges = {
+    'rne': (0, 1, (True, True)),
+    'ose': (0, 1, (True, True)),
+    'rne_se': (0, 1, (True, True)),
+    'ose_se': (0, 1, (True, True)),
+    'opening_job_gains': (0, float('inf'), (True, False)),
+    'establishments': (0, float('inf'), (True, False)),
+    'Lestablishments': (0, float('inf'), (False, False)),
+    'population': (0, float('inf'), (False, False))
+}
+validation_jumps = {'population': 1.15, 'opening_job_gains': 4, 'establishments': 4, 'Lestablishments': 4}
+
+# Output file formats, and the number of output files written at once
+output_formats = ('csv', 'csv.gz', 'csv.zst', 'parquet')
+output_workers = 6
+
+# S3 locations of the raw data and of the outputs, and the settings of s3_sync: files above the multipart threshold are
+# uploaded in parts of multipart_chunksize
+s3_bucket = 'emkf.data.research'
+s3_raw_data_prefix = 'indicators/kese/raw_data'
+s3_outputs_prefix = 'indicators/kese/data_outputs/kcr_kese_calculator'
+s3_workers = 8
+s3_multipart_threshold = 64 * 1024 ** 2
+s3_multipart_chunksize = 16 * 1024 ** 2
+
+# Import-time budgets of the command line entry points and the modules their subcommands import, in
+# seconds, and the optional and network dependencies they must not import until a subcommand needs them
+# (see kese_benchmark.py --imports)
+import_budgets = {'tools.kese_cli': 0.05, 'tools.kese_command': 1.0, 'tools.kese_raw_data_fetch': 1.0}
+import_lazy_modules = ['kauffman', 'boto3', 'botocore', 'fsspec', 's3fs', 'polars', 'zstandard', 'joblib']
+
 kese_categories = {
     'Total':['Total'],
     'Sex':['Men', 'Women'],
@@ -0,0 +1,553 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import http.client
+import numpy as np
+import pandas as pd
+import tools.constants as c
+import tools.kese_helpers as h
+import tools.kese_cache as kc
+import tools.kese_profile as kp
+import tools.kese_command as kese
+import tools.kese_query as kq
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+
+def synthetic_cps_microdata(n_rows, year, seed=0):
+    """
+    Generate raw CPS microdata with the columns of kieadata{year}.csv used by the indicators.
+
+    Parameters
+    ----------
+    n_rows : int
+        Number of respondents
+
+    year : int
+        Year of the data
+
+    seed : int
+        Seed of the random number generator
+
+    Returns
+    -------
+    DataFrame
+        The microdata
+    """
+    rng = np.random.default_rng([seed, year])
+    return pd.DataFrame(
+        {
+            'yeart1': year,
+            'state': rng.choice(list(c.cps_states_dic), n_rows),
+            'ent015ua': np.where(rng.random(n_rows) < .05, np.nan, rng.random(n_rows) < .003),
+            'oppshare': np.where(rng.random(n_rows) < .997, np.nan, rng.random(n_rows) < .8),
+            'wgtat1': rng.uniform(500, 5000, n_rows),
+            'age': rng.integers(16, 81, n_rows),
+            'grdatn': rng.integers(31, 47, n_rows),
+            'immigr': rng.integers(0, 2, n_rows),
+            'race': rng.integers(1, 5, n_rows),
+            'spneth': rng.integers(0, 3, n_rows),
+            'female': rng.integers(0, 2, n_rows),
+            'vet': rng.integers(0, 2, n_rows),
+        }
+    )
+
+
+def _synthetic_geographies(region, scale, counties=0):
+    """Return the fips codes and names of the synthetic geographies of a given level."""
+    if region == 'us':
+        return pd.DataFrame({'fips': ['00'], 'region': ['United States']})
+    states = pd.DataFrame(sorted(c.state_fips_abb_dic.items()), columns=['fips', 'abb']).\
+        query('abb not in ["US", "PR"]')
+    if region == 'county':
+        return pd.DataFrame(
+            {
+                'fips': [f'{fips}{county:03d}' for fips in states['fips'] for county in range(1, counties + 1)],
+                'region': [
+                    f'County {county}, {abb}' for abb in states['abb'] for county in range(1, counties + 1)
+                ]
+            }
+        )
+    return pd.DataFrame(
+        {
+            'fips': [f'{fips}{copy:03d}' if scale > 1 else fips for copy in range(scale) for fips in states['fips']],
+            'region': [
+                f'{c.abbrev_us_state[abb]} {copy}' if scale > 1 else c.abbrev_us_state[abb]
+                for copy in range(scale) for abb in states['abb']
+            ]
+        }
+    )
+
+
+def synthetic_raw_data(scale=1, seed=0, counties=0):
+    """
+    Generate raw CPS, BED, and PEP data with the schemas of the files in data/raw_data.
+
+    Parameters
+    ----------
+    scale : int
+        Number of copies of each state in the state-level data; 1 matches the size of the bundled data
+
+    seed : int
+        Seed of the random number generator
+
+    counties : int
+        If positive, the number of counties of each state in a county-level data set, built from BED and
+        PEP data only, as the real county level is. About 60 counties per state matches the size of the
+        real county level.
+
+    Returns
+    -------
+    dict
+        The data, keyed by the name of the corresponding file in data/raw_data
+    """
+    rng = np.random.default_rng(seed)
+    years = np.arange(1996, 2022)
+    bed_years = np.arange(1994, 2022)
+    data = {}
+    for region in ['us', 'state'] + (['county'] if counties > 0 else []):
+        geos = _synthetic_geographies(region, scale, counties)
+        categories = h._categories if region == 'us' else [('Total', 'Total')]
+
+        if c.geographies[region]['cps']:
+            data[f'cps_{region}'] = geos.\
+                merge(pd.DataFrame(categories, columns=['type', 'category']), how='cross').\
+                merge(pd.DataFrame({'time': years}), how='cross').\
+                assign(
+                    rne=lambda x: rng.uniform(.001, .005, len(x)),
+                    ose=lambda x: rng.uniform(.6, .95, len(x))
+                )
+
+        data[f'bed_table1_{region}'] = geos.\
+            merge(pd.DataFrame({'time': bed_years}), how='cross').\
+            assign(
+                firms=lambda x: rng.integers(1000, 100000, len(x)),
+                establishments=lambda x: x['firms'] + rng.integers(0, 1000, len(x)),
+                opening_job_gains=lambda x: rng.integers(5000, 500000, len(x)),
+                net_change=lambda x: x['opening_job_gains'],
+                total_job_gains=lambda x: x['opening_job_gains'],
+                expanding_job_gains=0,
+                total_job_losses=0,
+                contracting_job_losses=0,
+                closing_job_losses=0
+            )
+
+        cohorts = pd.DataFrame(
+            [(start, end) for start in bed_years for end in bed_years if end >= start],
+            columns=['time', 'end_year']
+        )
+        data[f'bed_table7_{region}'] = geos.\
+            merge(cohorts, how='cross').\
+            assign(
+                firm_age=lambda x: x['end_year'] - x['time'],
+                establishments=lambda x: (rng.integers(5000, 500000, len(x)) * .8 ** x['firm_age']).astype(int),
+                employment=lambda x: x['establishments'] * 7,
+                survival_since_birth=lambda x: 100 * .8 ** x['firm_age'],
+                survival_previous_year=80.,
+                average_emp=7.,
+                Lestablishments=lambda x: x['establishments'].shift(1)
+            )
+
+        data[f'pep_{region}'] = geos.\
+            merge(pd.DataFrame({'time': years}), how='cross').\
+            assign(population=lambda x: rng.integers(500000, 40000000, len(x)).astype(float))
+
+    return data
+
+
+def bundled_raw_data():
+    """Read the raw CPS, BED, and PEP data in data/raw_data."""
+    data = dict(zip(['cps_us', 'cps_state'], kese._fetch_data_cps(False)))
+    for region in ['us', 'state']:
+        data[f'bed_table1_{region}'], data[f'bed_table7_{region}'] = kese._fetch_data_bed(region, False)
+        data[f'pep_{region}'] = kese._fetch_data_pep(region, False)
+    return data
+
+
+def _git_commit():
+    """Return the commit of the repository, or None if it cannot be determined."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=c.filenamer(''), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _copied(args, kwargs):
+    """Deep copies of the DataFrame arguments of a stage, since some stages modify their inputs in place."""
+    return [arg.copy() if isinstance(arg, pd.DataFrame) else arg for arg in args], \
+        {key: arg.copy() if isinstance(arg, pd.DataFrame) else arg for key, arg in kwargs.items()}
+
+
+def _timed(results, stage, func, *args, memory=True, **kwargs):
+    """
+    Run a stage, recording its wall time and its output rows. With memory, the stage is run a second
+    time under tracemalloc to record the peak memory it allocates, so that tracing does not slow down
+    the timed run. Both runs get their own copies of the DataFrame arguments, so that the second run
+    sees the same inputs as the first and the caller's frames are left as the pipeline would leave
+    them. Memory allocated by pyarrow, e.g. when reading Parquet, is not traced.
+    """
+    run_args, run_kwargs = _copied(args, kwargs)
+    start = time.perf_counter()
+    out = func(*run_args, **run_kwargs)
+    seconds = time.perf_counter() - start
+
+    peak_mb = None
+    if memory:
+        run_args, run_kwargs = _copied(args, kwargs)
+        tracemalloc.start()
+        func(*run_args, **run_kwargs)
+        peak_mb = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+        tracemalloc.stop()
+
+    results.append(
+        {
+            'stage': stage,
+            'seconds': round(seconds, 6),
+            'rows_out': len(out) if isinstance(out, pd.DataFrame) else None,
+            'peak_traced_mb': peak_mb
+        }
+    )
+    return out
+
+
+def _stages_run(stages, source, scale, counties, micro_rows, output_formats, memory, tmp_dir):
+    """Run and time the stages of the pipeline, with the Parquet store and the outputs in tmp_dir."""
+    df_micro = synthetic_cps_microdata(micro_rows, 2021)
+    for region in ['us', 'state']:
+        _timed(stages, f'preprocess_cps_{region}', h.preprocess_cps, df_micro, region, memory=memory)
+        _timed(
+            stages, f'preprocess_cps_se_{region}', h.preprocess_cps, df_micro, region, [c.cps_replicate_seed, 2021],
+            memory=memory
+        )
+    del df_micro
+
+    if source == 'synthetic':
+        data = _timed(stages, 'raw_data_load', synthetic_raw_data, scale, counties=counties, memory=memory)
+    else:
+        data = _timed(stages, 'raw_data_load', bundled_raw_data, memory=memory)
+    regions = ['us', 'state'] + (['county'] if 'pep_county' in data else [])
+    for name, df in data.items():
+        _timed(stages, f'temp_save_{name}', h.temp_save, df, name, memory=memory)
+
+    df_indicators = {}
+    for region in regions:
+        df = _timed(stages, f'_raw_data_merge_{region}', kese._raw_data_merge, region, memory=memory)
+        _timed(stages, f'_merged_validate_{region}', kese._merged_validate, df, region, memory=memory)
+        df_indicators[region] = _timed(
+            stages, f'_indicators_create_{region}', kese._indicators_create, df, region, memory=memory
+        )
+    baseline = _timed(stages, '_index_baseline', kese._index_baseline, df_indicators['us'], memory=memory)
+
+    df = pd.concat(
+        [
+            _timed(
+                stages, f'_index_create_{region}', kese._index_create, df_indicators[region], *baseline, memory=memory
+            ).\
+                pipe(kese._final_data_transform)
+            for region in regions
+        ]
+    )
+
+    df_alley = _timed(
+        stages, '_download_to_alley_formatter', kese._download_to_alley_formatter, df,
+        ['rne', 'ose', 'sjc', 'ssr', 'zindex'], memory=memory
+    )
+    frames = {'kese_download': df}
+    for indicator in ['rne', 'ose', 'sjc', 'ssr', 'zindex']:
+        frames[f'kese_website_{indicator}'] = _timed(
+            stages, f'_alley_outcome_{indicator}', kese._alley_outcome, df_alley, indicator, memory=memory
+        ).reset_index()
+    _timed(
+        stages, 'outputs_write', h.outputs_write, frames, formats=output_formats,
+        directory=os.path.join(tmp_dir, 'outputs'), memory=memory
+    )
+
+
+def benchmark_run(
+        source='synthetic', scale=1, micro_rows=1000000, output=c.filenamer('data/benchmarks/kese_benchmark.jsonl'),
+        output_formats=('csv',), memory=True, counties=0
+):
+    """
+    Time each stage of the KESE pipeline and append the results to a JSON lines file, tagged with the
+    commit, so that runs can be compared across commits.
+
+    The Parquet store and the outputs are written to a temporary directory, which is removed at the
+    end, so the data in data, including data/temp, is left untouched. The stage cache is disabled.
+
+    Parameters
+    ----------
+    source : str
+        'synthetic' for data from synthetic_raw_data, or 'bundled' for the data in data/raw_data
+
+    scale : int
+        Size of the synthetic state-level data, as a multiple of the bundled data. Ignored when source
+        is 'bundled'.
+
+    micro_rows : int
+        Number of rows of synthetic CPS microdata used to time preprocess_cps, without and with the
+        bootstrap standard errors
+
+    output : str
+        The JSON lines file to which the results are appended
+
+    output_formats : iterable
+        Formats in which the outputs are written by h.outputs_write. Options: c.output_formats
+
+    memory : bool
+        When true, the peak memory allocated by each stage is traced in a second, untimed run of the
+        stage, which doubles the time the benchmark takes
+
+    counties : int
+        If positive, a synthetic county level with this many counties per state is added, to time a
+        level of the size of the real county level (about 60). Ignored when source is 'bundled'.
+
+    Returns
+    -------
+    dict
+        The results
+    """
+    cache_enabled, temp_dir = kc.settings['enabled'], h.settings['temp_dir']
+    stages = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        kc.settings['enabled'] = False
+        h.settings['temp_dir'] = os.path.join(tmp_dir, 'temp')
+        try:
+            _stages_run(stages, source, scale, counties, micro_rows, output_formats, memory, tmp_dir)
+        finally:
+            kc.settings['enabled'], h.settings['temp_dir'] = cache_enabled, temp_dir
+
+    results = {
+        'commit': _git_commit(),
+        'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'source': source,
+        'scale': scale if source == 'synthetic' else 1,
+        'counties': counties if source == 'synthetic' else 0,
+        'micro_rows': micro_rows,
+        'output_formats': list(output_formats),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'total_seconds': round(sum(stage['seconds'] for stage in stages), 6),
+        'peak_rss_mb': kp._peak_rss_mb(),
+        'stages': stages
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'a') as f:
+        f.write(json.dumps(results) + '\n')
+    return results
+
+
+def _query_mix(df):
+    """Return the queries of the load test: each state's time series, all states in each year, and each US demographic."""
+    return [('/series', {'fips': fips}) for fips in df['fips'].unique()] + \
+        [('/year', {'year': year}) for year in df['year'].unique()] + \
+        [
+            ('/demographic', {'type': type_, 'category': category})
+            for type_, category in df.query('fips == "00"')[['type', 'category']].drop_duplicates().itertuples(index=False)
+        ]
+
+
+def _query_client(port, queries, n_requests):
+    """Send n_requests queries over one kept-alive connection, returning the latency of each in seconds."""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    latencies = []
+    for i in range(n_requests):
+        path, params = queries[i % len(queries)]
+        start = time.perf_counter()
+        conn.request('GET', f'{path}?{urlencode(params)}')
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise ValueError(f'{path} {params} returned {response.status}')
+    conn.close()
+    return latencies
+
+
+def query_benchmark_run(
+        n_requests=20000, clients=8, calls=10000, path=kq.settings['path'],
+        output=c.filenamer('data/benchmarks/kese_query_benchmark.jsonl')
+):
+    """
+    Load test the query API of kese_query.py, and append the results to a JSON lines file, tagged with
+    the commit. The queries are timed as library calls, and over HTTP from concurrent local clients
+    against a server on a free port. For comparison, the reading and filtering of the download csv that
+    a query replaces is also timed.
+
+    Parameters
+    ----------
+    n_requests : int
+        Number of HTTP requests, split among the clients
+
+    clients : int
+        Number of concurrent clients, each with its own connection
+
+    calls : int
+        Number of library calls of each query
+
+    path : str
+        The download-version of the data
+
+    output : str
+        The JSON lines file to which the results are appended
+
+    Returns
+    -------
+    dict
+        The results
+    """
+    start = time.perf_counter()
+    df = kq._read(path)
+    df.query('fips == "06" and type == "Total" and category == "Total"')
+    read_filter_seconds = time.perf_counter() - start
+    queries = _query_mix(df)
+
+    kq.reload(path)
+    library = {}
+    for name, func, args in [
+        ('cell', kq.cell, ('06', 'Total', 'Total', 2020)),
+        ('series', kq.series, ('06',)),
+        ('year', kq.year, (2020,)),
+        ('demographic', kq.demographic, ('Sex', 'Women'))
+    ]:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func(*args)
+        library[name] = round((time.perf_counter() - start) / calls * 1e6, 3)
+
+    server = kq.serve(port=0, path=path)
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = np.concatenate(
+            list(pool.map(lambda _: _query_client(server.server_port, queries, n_requests // clients), range(clients)))
+        )
+    wall = time.perf_counter() - wall
+    server.shutdown()
+    server.server_close()
+
+    results = {
+        'commit': _git_commit(),
+        'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'rows': len(df),
+        'read_filter_csv_ms': round(read_filter_seconds * 1e3, 3),
+        'library_us': library,
+        'http': {
+            'clients': clients,
+            'requests': len(latencies),
+            'requests_per_second': round(len(latencies) / wall, 1),
+            **{f'p{q}_ms': round(np.percentile(latencies, q) * 1e3, 3) for q in [50, 95, 99]}
+        }
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'a') as f:
+        f.write(json.dumps(results) + '\n')
+    return results
+
+
+def import_benchmark_run(repeats=5, output=c.filenamer('data/benchmarks/kese_import_benchmark.jsonl')):
+    """
+    Time the import of each command line entry point in c.import_budgets in a fresh interpreter, and
+    check it against its budget and that none of c.import_lazy_modules is imported with it. The results
+    are appended to a JSON lines file, tagged with the commit.
+
+    Parameters
+    ----------
+    repeats : int
+        Number of fresh interpreters per module; the fastest import is compared with the budget
+
+    output : str
+        The JSON lines file to which the results are appended
+
+    Returns
+    -------
+    dict
+        The results, with 'passed' false if any module is over its budget, imports a lazy module, or
+        fails to import
+    """
+    probe = 'import sys, time, json; start = time.perf_counter(); import {module}; ' \
+        'print(json.dumps({{"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}}))'
+    modules = {}
+    for module, budget in c.import_budgets.items():
+        runs = [
+            subprocess.run(
+                [sys.executable, '-c', probe.format(module=module)], cwd=c.filenamer(''), capture_output=True, text=True
+            )
+            for _ in range(repeats)
+        ]
+        failed = [run.stderr.strip().splitlines()[-1] for run in runs if run.returncode != 0]
+        if failed:
+            modules[module] = {'budget_seconds': budget, 'error': failed[0], 'passed': False}
+            continue
+        probes = [json.loads(run.stdout) for run in runs]
+        seconds = min(probe['seconds'] for probe in probes)
+        lazy = sorted(
+            {name for probe in probes for name in probe['modules'] if name.split('.')[0] in c.import_lazy_modules}
+        )
+        modules[module] = {
+            'seconds': round(seconds, 4),
+            'budget_seconds': budget,
+            'lazy_modules_imported': lazy,
+            'passed': seconds <= budget and not lazy
+        }
+
+    results = {
+        'commit': _git_commit(),
+        'timestamp': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'modules': modules,
+        'passed': all(module['passed'] for module in modules.values())
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'a') as f:
+        f.write(json.dumps(results) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the KESE pipeline.')
+    parser.add_argument('--source', choices=['synthetic', 'bundled'], default='synthetic')
+    parser.add_argument('--scale', type=int, default=1, help='size of the synthetic data, up to 100x the bundled data')
+    parser.add_argument(
+        '--counties', type=int, default=0, help='add a synthetic county level with this many counties per state'
+    )
+    parser.add_argument('--micro-rows', type=int, default=1000000, help='rows of synthetic CPS microdata')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--formats', nargs='+', default=['csv'], choices=list(c.output_formats), help='output formats')
+    parser.add_argument('--no-memory', action='store_true', help='skip the untimed tracemalloc run of each stage')
+    parser.add_argument('--query', action='store_true', help='load test the query API of kese_query.py instead')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients of the query load test')
+    parser.add_argument('--requests', type=int, default=20000, help='requests of the query load test')
+    parser.add_argument(
+        '--imports', action='store_true', help='check the import times of the entry points against c.import_budgets instead'
+    )
+    args = parser.parse_args()
+
+    if args.imports:
+        results = import_benchmark_run(output=args.output or c.filenamer('data/benchmarks/kese_import_benchmark.jsonl'))
+        for module, result in results['modules'].items():
+            print(f'{module:<45}{json.dumps(result)}')
+        sys.exit(0 if results['passed'] else 1)
+    elif args.query:
+        results = query_benchmark_run(
+            args.requests, args.clients, output=args.output or c.filenamer('data/benchmarks/kese_query_benchmark.jsonl')
+        )
+        print(f"read and filter csv{results['read_filter_csv_ms']:>27.3f}ms")
+        for name, us in results['library_us'].items():
+            print(f"{name:<45}{us:>10.3f}us")
+        print(json.dumps(results['http']))
+    else:
+        results = benchmark_run(
+            args.source, args.scale, args.micro_rows, args.output or c.filenamer('data/benchmarks/kese_benchmark.jsonl'),
+            args.formats, not args.no_memory, args.counties
+        )
+        for stage in results['stages']:
+            peak = f"{stage['peak_traced_mb']:>10.1f}MB" if stage['peak_traced_mb'] is not None else ''
+            print(f"{stage['stage']:<45}{stage['seconds']:>10.3f}s{peak}")
+        print(f"{'total':<45}{results['total_seconds']:>10.3f}s")
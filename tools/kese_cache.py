@@ -0,0 +1,118 @@
+import os
+import inspect
+import hashlib
+import tempfile
+import functools
+import pandas as pd
+import tools.constants as c
+import tools.kese_profile as kp
+
+settings = {
+    'enabled': True,
+    'cache_dir': c.filenamer('data/cache/stages'),
+    'max_bytes': c.stage_cache_max_bytes
+}
+
+
+def _hash_update(m, obj):
+    """Add an object to a running hash. DataFrames and Series are hashed by content."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        m.update(repr(obj.dtypes.astype(str).to_dict() if isinstance(obj, pd.DataFrame) else obj.dtype).encode())
+        m.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, (tuple, list)):
+        m.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for item in obj:
+            _hash_update(m, item)
+    else:
+        m.update(repr(obj).encode())
+
+
+def _file_hash(path):
+    """Return the sha256 of the content of a file, or None if it does not exist."""
+    if not os.path.isfile(path):
+        return None
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            m.update(block)
+    return m.hexdigest()
+
+
+def _evict(cache_dir, max_bytes):
+    """Remove the least recently used cache entries until the cache is no larger than max_bytes."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.name.endswith('.pkl'):
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+        except FileNotFoundError:  # removed by a concurrent stage
+            pass
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def stage_cache(inputs=None, constants=(), code=()):
+    """
+    Memoize a pipeline stage on a hash of everything its result depends on: its arguments (DataFrames
+    are hashed by content), the content of the files it reads, the tools.constants values it uses, and
+    its source code. Unchanged stages are loaded from data/cache/stages instead of being rerun.
+
+    Parameters
+    ----------
+    inputs : callable
+        Called with the stage's arguments, by name and with the defaults applied; returns the paths of
+        the files the stage reads, or None if the stage cannot be cached for these arguments (e.g. when
+        fetching data from source).
+
+    constants : iterable
+        Names of the tools.constants values the stage depends on
+
+    code : iterable
+        Functions called by the stage, or modules used by it, whose source code the result depends on,
+        and other module-level values it uses, e.g. lists of column names, whose value it depends on
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Positional and keyword calls of the same arguments share an entry
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            files_in = inputs(**bound.arguments) if inputs else []
+            if not settings['enabled'] or files_in is None:
+                return func(*args, **kwargs)
+
+            m = hashlib.sha256()
+            for f in (func,) + tuple(code):
+                source = inspect.getsource(f) if inspect.ismodule(f) or callable(f) else repr(f)
+                m.update(source.encode())
+            _hash_update(m, list(bound.arguments.items()))
+            _hash_update(m, [getattr(c, name) for name in constants])
+            _hash_update(m, [_file_hash(path) for path in files_in])
+            path = os.path.join(settings['cache_dir'], f'{func.__name__}_{m.hexdigest()}.pkl')
+
+            import joblib
+            if os.path.isfile(path):
+                kp.log(f'\t{func.__name__}: unchanged, loading from cache')
+                os.utime(path)
+                return joblib.load(path)
+
+            value = func(*args, **kwargs)
+            os.makedirs(settings['cache_dir'], exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=settings['cache_dir'], suffix='.tmp')
+            os.close(fd)
+            joblib.dump(value, tmp_path)
+            os.replace(tmp_path, path)
+            _evict(settings['cache_dir'], settings['max_bytes'])
+            return value
+        return wrapper
+    return decorator
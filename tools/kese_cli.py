@@ -0,0 +1,131 @@
+import os
+import sys
+import argparse
+import tools.constants as c
+
+# The pipeline modules import pandas, and the subcommands that fetch or publish data import the kauffman
+# library and boto3. All of them are imported by the subcommand that needs them, so that the parser,
+# e.g. --help, starts instantly and offline builds never load the network libraries.
+
+
+def fetch(args):
+    """Fetch the raw data from source into data/raw_data and, with --upload, sync it to S3."""
+    import tools.kese_raw_data_fetch as rdf
+    rdf.raw_data_update(args.regions)
+    if args.upload:
+        rdf.s3_update(args.regions, dry_run=args.dry_run)
+
+
+def build(args):
+    """Create the KESE data with kese_data_create_all."""
+    import tools.kese_command as kese
+    import tools.kese_validate as kv
+    kv.settings['on_error'] = args.on_validation_error
+    kese.kese_data_create_all(
+        raw_data_fetch=args.fetch,
+        raw_data_remove=not args.keep_temp,
+        aws_filepath=args.aws_filepath,
+        incremental=args.incremental,
+        use_cache=not args.no_cache,
+        regions=args.regions,
+        profile=args.profile,
+        output_formats=args.formats,
+        backend=args.backend
+    )
+
+
+def publish(args):
+    """Sync the outputs in data, and with --raw-data the raw data, to S3, uploading only the files that changed."""
+    import tools.kese_raw_data_fetch as rdf
+    directory = c.filenamer('data')
+    files = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith(f'kcr_calc_{args.tag}_kese_')
+    )
+    if not files:
+        raise SystemExit(f'No outputs named kcr_calc_{args.tag}_kese_* in data; run the build subcommand first')
+    rdf.s3_sync(files, c.s3_bucket, args.prefix, dry_run=args.dry_run)
+    if args.raw_data:
+        rdf.s3_update(args.regions, dry_run=args.dry_run)
+
+
+def validate(args):
+    """
+    Merge the raw data in data/raw_data and validate it, as a build does before computing the indicators,
+    and print the report. Exits with status 1 if any check fails with an error.
+    """
+    import pandas as pd
+    import tools.kese_command as kese
+    import tools.kese_validate as kv
+    import tools.kese_cache as kc
+    kc.settings['enabled'] = not args.no_cache
+    kese._raw_data_fetch(False, args.regions)
+    reports = [
+        kv.merged_validate(kese._raw_data_merge(region), region).assign(region=region) for region in args.regions
+    ]
+    kese._raw_data_remove(not args.keep_temp)
+
+    report = pd.concat(reports, ignore_index=True)
+    with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+        print(report[['region', 'check', 'column', 'severity', 'failures', 'examples']].to_string(index=False))
+    if report.query('severity == "error"')['failures'].any():
+        sys.exit(1)
+
+
+def _parser():
+    """The parser of the command line, with one subparser per subcommand."""
+    parser = argparse.ArgumentParser(prog='python -m tools.kese_cli', description='Create the KESE indicators.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def _regions(subparser):
+        subparser.add_argument(
+            '--regions', nargs='+', default=['us', 'state'], choices=list(c.geographies),
+            help='geographical levels of the data (default: us state)'
+        )
+
+    sub = subparsers.add_parser('fetch', help='fetch the raw data from source into data/raw_data')
+    _regions(sub)
+    sub.add_argument('--upload', action='store_true', help='sync the raw data to S3 after fetching it')
+    sub.add_argument('--dry-run', action='store_true', help='print the S3 sync plan without uploading')
+    sub.set_defaults(func=fetch)
+
+    sub = subparsers.add_parser('build', help='create the KESE data from the raw data')
+    _regions(sub)
+    sub.add_argument('--fetch', action='store_true', help='fetch the raw data from source instead of data/raw_data')
+    sub.add_argument('--keep-temp', action='store_true', help='keep the intermediate data in data/temp')
+    sub.add_argument('--aws-filepath', default=None, help='also stash the outputs here, e.g. s3://bucket/prefix')
+    sub.add_argument('--incremental', action='store_true', help='recompute only the years whose raw data changed')
+    sub.add_argument('--no-cache', action='store_true', help='rerun every stage instead of loading unchanged ones')
+    sub.add_argument('--profile', choices=['cprofile', 'tracemalloc'], default=None)
+    sub.add_argument('--formats', nargs='+', default=['csv'], choices=list(c.output_formats))
+    sub.add_argument('--backend', choices=['pandas', 'polars'], default='pandas')
+    sub.add_argument(
+        '--on-validation-error', choices=['raise', 'warn'], default='raise',
+        help='stop the run, or only log, when the merged data fails validation'
+    )
+    sub.set_defaults(func=build)
+
+    sub = subparsers.add_parser('publish', help='sync the outputs in data to S3')
+    _regions(sub)
+    sub.add_argument('--tag', default=str(c.vintage), help='tag of the output files (default: the vintage)')
+    sub.add_argument('--prefix', default=c.s3_outputs_prefix, help=f's3://{c.s3_bucket} key prefix of the outputs')
+    sub.add_argument('--raw-data', action='store_true', help='also sync the raw data in data/raw_data')
+    sub.add_argument('--dry-run', action='store_true', help='print the S3 sync plan without uploading')
+    sub.set_defaults(func=publish)
+
+    sub = subparsers.add_parser('validate', help='validate the merged raw data in data/raw_data')
+    _regions(sub)
+    sub.add_argument('--keep-temp', action='store_true', help='keep the intermediate data in data/temp')
+    sub.add_argument('--no-cache', action='store_true', help='rerun every stage instead of loading unchanged ones')
+    sub.set_defaults(func=validate)
+    return parser
+
+
+def main(argv=None):
+    """Parse the command line and run the subcommand, e.g. python -m tools.kese_cli build --formats csv parquet."""
+    args = _parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
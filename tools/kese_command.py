@@ -1,46 +1,57 @@
 import os
 import sys
 import shutil
-import joblib
 import numpy as np
 import pandas as pd
 import tools.constants as c
 import tools.kese_helpers as h
-from kauffman.data import pep, bed
+import tools.kese_cache as kc
+import tools.kese_profile as kp
+import tools.kese_schema as ks
+import tools.kese_pep as kpep
+import tools.kese_validate as kv
+from tools.kese_cache import stage_cache
 
 
-def _format_csv(df):
-    return df. \
-        astype({'fips': 'str', 'time': 'int'})
+def _raw_data_files(*names):
+    """Return the stage_cache inputs of a fetch stage: the files in data/raw_data, or None when fetching from source."""
+    return lambda fetch_data, region=None: None if fetch_data else \
+        [c.filenamer(f'data/raw_data/{name.format(region=region)}.csv') for name in names]
 
 
+@stage_cache(
+    inputs=_raw_data_files('cps_us', 'cps_state'),
+    constants=['kese_categories', 'kese_category_queries', 'cps_to_fips', 'geographies'],
+    code=[ks, h.preprocess_cps]
+)
 def _fetch_data_cps(fetch_data):
     """
     Fetch CPS data from https://people.ucsc.edu/~rfairlie/data/microdata/. Pre-process the data.
 
     Parameters
     ----------
-    region : str
-        Geographical level of data to be fetched. Options: 'us' or 'state'
+    fetch_data : bool
+        When true, code fetches the raw data from source; otherwise, it uses the data in data/raw_data.
+
+    Returns
+    -------
+    tuple
+        The US- and state-level data
     """
-    print('Fetching CPS data')
+    kp.log('Fetching CPS data')
 
     if fetch_data:
-        df_us = pd.DataFrame()
-        df_state = pd.DataFrame()
-        for year in range(1996, 2022):
-            df_in = pd.read_csv(f'https://people.ucsc.edu/~rfairlie/data/microdata/kieadata{year}.csv')
-
-            df_us = df_us.append(h.preprocess_cps(df_in, 'us'))
-            df_state = df_state.append(h.preprocess_cps(df_in, 'state'))
+        df_us, df_state = h.cps_fetch()
     else:
-        df_us = pd.read_csv(c.filenamer(f'data/raw_data/cps_us.csv')).pipe(_format_csv)
-        df_state = pd.read_csv(c.filenamer(f'data/raw_data/cps_state.csv')).pipe(_format_csv)
+        df_us = pd.read_csv(kp.read_path(c.filenamer('data/raw_data/cps_us.csv')))
+        df_state = pd.read_csv(kp.read_path(c.filenamer('data/raw_data/cps_state.csv')))
 
-    joblib.dump(df_us, c.filenamer(f'data/temp/cps_us.pkl'))
-    joblib.dump(df_state, c.filenamer(f'data/temp/cps_state.pkl'))
+    return ks.schema_apply(df_us, 'us'), ks.schema_apply(df_state, 'state')
 
 
+@stage_cache(
+    inputs=_raw_data_files('bed_table1_{region}', 'bed_table7_{region}'), constants=['geographies'], code=[ks]
+)
 def _fetch_data_bed(region, fetch_data):
     """
     Fetch raw BED data. Data comes from two tables: table 1bf and 7.
@@ -48,54 +59,75 @@ def _fetch_data_bed(region, fetch_data):
     Parameters
     ----------
     region : str
-        Geographical level of data to be fetched. Options: 'us' or 'state'
+        Geographical level of data to be fetched. Options: the keys of c.geographies
 
     fetch_data : bool
         When true, code fetches the raw data from source; otherwise, it uses the data in data/raw_data.
+
+    Returns
+    -------
+    tuple
+        Tables 1bf and 7
     """
     if fetch_data:
-        print(f'\tcreating datasets neb/data/temp/bed_table1_{region}.pkl and neb/data/temp/bed_table7_{region}.pkl')
+        from kauffman.data import bed
+        kp.log(f'\tcreating datasets data/temp/bed_table1_{region}.parquet and data/temp/bed_table7_{region}.parquet')
         df_t1 = bed(series='establishment age and survival', table='1bf', obs_level=region)
 
         df_t7 = bed(series='establishment age and survival', table=7, obs_level=region). \
             rename(columns={'age': 'firm_age'}). \
             assign(Lestablishments=lambda x: x['establishments'].shift(1))
     else:
-        df_t1 = pd.read_csv(c.filenamer(f'data/raw_data/bed_table1_{region}.csv')).pipe(_format_csv)
-        df_t7 = pd.read_csv(c.filenamer(f'data/raw_data/bed_table7_{region}.csv')).pipe(_format_csv)
+        df_t1 = pd.read_csv(kp.read_path(c.filenamer(f'data/raw_data/bed_table1_{region}.csv')))
+        df_t7 = pd.read_csv(kp.read_path(c.filenamer(f'data/raw_data/bed_table7_{region}.csv')))
 
-    joblib.dump(df_t1, c.filenamer(f'data/temp/bed_table1_{region}.pkl'))
-    joblib.dump(df_t7, c.filenamer(f'data/temp/bed_table7_{region}.pkl'))
+    return ks.schema_apply(df_t1, region), ks.schema_apply(df_t7, region)
 
 
+@stage_cache(inputs=_raw_data_files('pep_{region}'), constants=['geographies'], code=[ks, kpep])
 def _fetch_data_pep(region, fetch_data):
     """
-    Fetch raw PEP data.
+    Fetch raw PEP data, stitched from the sources in kese_pep.sources.
 
     Parameters
     ----------
     region : str
-        Geographical level of data to be fetched. Options: 'us' or 'state'
+        Geographical level of data to be fetched. Options: the keys of c.geographies
 
     fetch_data : bool
         When true, code fetches the raw data from source; otherwise, it uses the data in data/raw_data.
+
+    Returns
+    -------
+    DataFrame
+        The population data
     """
     if fetch_data:
-        print(f'\tcreating dataset neb/data/temp/pep_{region}.pkl')
-        df = pep(region).\
-            rename(columns={'POP': 'population'}).\
-            astype({'time': 'int', 'population': 'int'}).\
-            query('time >= 2000').\
-            append(h.pep_pre_2000(region)).\
-            sort_values(['fips', 'region', 'time']).\
-            reset_index(drop=True)
+        kp.log(f'\tcreating dataset data/temp/pep_{region}.parquet')
+        df = kpep.pep_load(region)
     else:
-        df = pd.read_csv(c.filenamer(f'data/raw_data/pep_{region}.csv')).pipe(_format_csv)
+        df = pd.read_csv(kp.read_path(c.filenamer(f'data/raw_data/pep_{region}.csv')))
+
+    return ks.schema_apply(df, region)
+
+
+def _raw_data_fetch_cps(fetch_data):
+    """Fetch raw CPS data and save it to data/temp."""
+    df_us, df_state = _fetch_data_cps(fetch_data)
+    h.temp_save(df_us, 'cps_us')
+    h.temp_save(df_state, 'cps_state')
 
-    joblib.dump(df, c.filenamer(f'data/temp/pep_{region}.pkl'))
 
+def _raw_data_fetch_region(region, fetch_data):
+    """Fetch raw BED and PEP data for a given geographical level and save it to data/temp."""
+    df_t1, df_t7 = _fetch_data_bed(region, fetch_data)
+    h.temp_save(df_t1, f'bed_table1_{region}')
+    h.temp_save(df_t7, f'bed_table7_{region}')
 
-def _raw_data_fetch(fetch_data):
+    h.temp_save(_fetch_data_pep(region, fetch_data), f'pep_{region}')
+
+
+def _raw_data_fetch(fetch_data, regions):
     """
     Fetch raw CPS, BED, and PEP data.
 
@@ -103,26 +135,46 @@ def _raw_data_fetch(fetch_data):
     ----------
     fetch_data : bool
         When true, code fetches the raw data from source; otherwise, it uses the data in data/raw_data.
-    """
-
-    if os.path.isdir(c.filenamer('data/temp')):
-        _raw_data_remove(remove_data=True)
-    os.mkdir(c.filenamer('data/temp'))
-
-    _fetch_data_cps(fetch_data)
-    for region in ['us', 'state']:
-        _fetch_data_bed(region, fetch_data)
-        _fetch_data_pep(region, fetch_data)
 
-
-def _raw_data_merge(region):
+    regions : list
+        Geographical levels of data to be fetched. Options: the keys of c.geographies
+    """
+    if any(c.geographies[region]['cps'] for region in regions):
+        _raw_data_fetch_cps(fetch_data)
+    for region in regions:
+        _raw_data_fetch_region(region, fetch_data)
+
+
+def _temp_name(name, vintage=None):
+    """Return the name in the Parquet store of a raw dataset, under data/temp/{vintage} for a batch vintage."""
+    return f'{vintage}/{name}' if vintage is not None else name
+
+
+@stage_cache(
+    inputs=lambda region, vintage=None: [
+        h.temp_path(f'{_temp_name(name, vintage)}_{region}')
+        for name in (['cps'] if c.geographies[region]['cps'] else []) + ['bed_table1', 'bed_table7', 'pep']
+    ],
+    constants=['geographies'],
+    code=[ks, h.temp_path, h.temp_load, h.categorical_keys, h.keyed_join, _temp_name]
+)
+def _raw_data_merge(region, vintage=None):
     """
-    Merge CPS, BED, and PEP data for a given geographical level.
+    Merge CPS, BED, and PEP data for a given geographical level. Levels not covered by the CPS are
+    built on the PEP panel, with missing RNE and OSE.
+
+    The fips codes of all tables share one categorical dtype, and the BED and PEP data are joined onto
+    the CPS data with h.keyed_join, by an integer encoding of (fips, year). Duplicate (fips, year) rows
+    in the BED or PEP data raise an error rather than multiply the rows of the CPS data.
 
     Parameters
     ----------
     region : str
-        Geographical level of the data. Options: 'us' or 'state'
+        Geographical level of the data. Options: the keys of c.geographies
+
+    vintage : int
+        Vintage of the raw data, as loaded by _vintage_raw_data_load. Defaults to the data fetched by
+        _raw_data_fetch.
 
     Returns
     -------
@@ -131,28 +183,75 @@ def _raw_data_merge(region):
     """
 
     # Prep CPS data
-    df_cps = joblib.load(c.filenamer(f'data/temp/cps_{region}.pkl'))
+    if c.geographies[region]['cps']:
+        df_cps = h.temp_load(_temp_name(f'cps_{region}', vintage))
+    else:
+        df_cps = h.temp_load(_temp_name(f'pep_{region}', vintage), columns=['fips', 'region', 'time']).\
+            assign(type='Total', category='Total', rne=np.nan, ose=np.nan)
 
     # Prep BED data
-    df_bed1 = joblib.load(c.filenamer(f'data/temp/bed_table1_{region}.pkl')) \
-        [['fips', 'time', 'opening_job_gains']]
+    df_bed1 = h.temp_load(_temp_name(f'bed_table1_{region}', vintage), columns=['fips', 'time', 'opening_job_gains'])
 
-    df_bed7 = joblib.load(c.filenamer(f'data/temp/bed_table7_{region}.pkl')). \
-        query('firm_age == 1') \
-        [['fips', 'end_year', 'establishments', 'Lestablishments']].\
+    df_bed7 = h.temp_load(
+        _temp_name(f'bed_table7_{region}', vintage),
+        columns=['fips', 'end_year', 'establishments', 'Lestablishments'],
+        filters=[('firm_age', '==', 1)]
+    ).\
         rename(columns={'end_year': 'time'})
 
     # Prep PEP data
-    df_pop = joblib.load(c.filenamer(f'data/temp/pep_{region}.pkl')) \
-        [['fips', 'time', 'population']]
+    df_pop = h.temp_load(_temp_name(f'pep_{region}', vintage), columns=['fips', 'time', 'population'])
+
+    df_cps, df_bed1, df_bed7, df_pop = h.categorical_keys([df_cps, df_bed1, df_bed7, df_pop], 'fips')
 
     return df_cps.\
-        merge(df_bed1, how='left', on=['time', 'fips']).\
-        merge(df_bed7, how='left', on=['time', 'fips']).\
-        merge(df_pop, how='left', on=['time', 'fips'])
+        pipe(h.keyed_join, [df_bed1, df_bed7, df_pop]).\
+        pipe(ks.schema_apply, region)
+
+
+def _merged_validate(df, region):
+    """
+    Validate the merged raw data of a geographical level with kv.merged_validate, and log the failing
+    checks. Errors raise a ValueError, unless kv.settings['on_error'] is 'warn'. Returns the data, so
+    that the stage can be chained between _raw_data_merge and _indicators_create.
+    """
+    if not kv.settings['enabled']:
+        return df
+    report = kv.merged_validate(df, region)
+    if report['failures'].any():
+        kp.log(f'Validation of the merged {region}-level data:\n' + kv.report_text(report, region))
+    if kv.settings['on_error'] == 'raise' and report.query('severity == "error"')['failures'].any():
+        raise ValueError(
+            f'The merged {region}-level data failed validation:\n' +
+            kv.report_text(report.query('severity == "error"'), region)
+        )
+    return df
 
 
-def _index_create(df, region):
+def _index_baseline(df, window=c.index_baseline):
+    """
+    Calculate the means and standard deviations of the US-level indicators over the baseline window
+    of the index.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The US-level indicators data
+
+    window : tuple
+        The first and last years of the baseline window
+
+    Returns
+    -------
+    tuple
+        The means and the standard deviations of rne, ose, sjc, and ssr
+    """
+    start, end = window
+    df_us = df.query('@start <= time <= @end and category == "Total"')
+    return df_us[['rne', 'ose', 'sjc', 'ssr']].mean(), df_us[['rne', 'ose', 'sjc', 'ssr']].std()
+
+
+def _index_create(df, us_means, us_std):
     """
     Generate the Kauffman index.
 
@@ -161,28 +260,17 @@ def _index_create(df, region):
     df : DataFrame
         The indicators data
 
-    region : str
-        Geographical level of data. Options: 'us' or 'state'
+    us_means : Series
+        The means of the US-level indicators over the baseline window, from _index_baseline
+
+    us_std : Series
+        The standard deviations of the US-level indicators over the baseline window, from _index_baseline
 
     Returns
     -------
     DataFrame
         The original data plus the new index variable
     """
-    if region == 'us':
-        # Generate the means and standard deviations of the US-level data indicators
-        df_us = df.query('1996 <= time <= 2015 and category == "Total"')
-        us_means = df_us[['rne', 'ose', 'sjc', 'ssr']].mean()
-        us_std = df_us[['rne', 'ose', 'sjc', 'ssr']].std()
-
-        # Save this information to the temp folder for future use by the state-level index creation
-        joblib.dump(us_means, c.filenamer('data/temp/us_means.pkl'))
-        joblib.dump(us_std, c.filenamer('data/temp/us_std.pkl'))
-
-    elif region == 'state':
-        us_means = joblib.load(c.filenamer('data/temp/us_means.pkl'))
-        us_std = joblib.load(c.filenamer('data/temp/us_std.pkl'))
-    
     return df.\
         assign(
             ose_z = lambda x: (x['ose'] - us_means['ose']) / us_std['ose'],
@@ -194,9 +282,11 @@ def _index_create(df, region):
         drop(columns=['ose_z', 'rne_z', 'sjc_z', 'ssr_z'])
 
 
+@stage_cache(code=[h.rolling_mean, h.rolling_se, h.se_columns])
 def _indicators_create(df, region):
     """
-    Calculate the remaining Kauffman indicators and the index.
+    Calculate the remaining Kauffman indicators. The index is generated separately by _index_create,
+    since it depends on the US-level indicators.
 
     Parameters
     ----------
@@ -204,7 +294,7 @@ def _indicators_create(df, region):
         Raw merged data
 
     region : str
-        Geographical level of data. Options: 'us' or 'state'
+        Geographical level of data. Options: the keys of c.geographies
 
     Returns
     -------
@@ -212,96 +302,236 @@ def _indicators_create(df, region):
         Indicators data
     """
 
-    # 3 year trailing average of certains subsets of the data (RNE and OSE for state-level, OSE for
-    # non-total US-level)
-    if region == 'state':
-        df[['rne', 'ose']] = df.groupby(['fips'])[['rne', 'ose']].\
-            transform(lambda x: x.rolling(window=3).mean())
-    else:   
+    # The merged data may be a cached or snapshotted frame, which is left as it is
+    df = df.copy()
+
+    # 3 year trailing average of certains subsets of the data (RNE and OSE for sub-national levels, OSE
+    # for non-total US-level), and of their standard errors where the raw data has them
+    se = [col for col in h.se_columns if col in df.columns]
+    if region != 'us':
+        df[['rne', 'ose']] = h.rolling_mean(df, ['fips'], ['rne', 'ose'])
+        if se:
+            df[se] = h.rolling_se(df, ['fips'], se)
+    else:
         df.loc[df.category != 'Total', 'ose'] = df[df.category != 'Total'].\
-            groupby(['fips', 'category'])['ose'].\
-            transform(lambda x: x.rolling(window=3).mean())
+            pipe(h.rolling_mean, ['fips', 'category'], ['ose'])['ose']
+        if 'ose_se' in se:
+            df.loc[df.category != 'Total', 'ose_se'] = df[df.category != 'Total'].\
+                pipe(h.rolling_se, ['fips', 'category'], ['ose_se'])['ose_se']
 
     # Generate Startup Early Job Creation (SJC) and Startup Early Survival Rate (SSR)
-    df['sjc'] = df['opening_job_gains'] / (df['population'] / 1000)
-    df['ssr'] = df['establishments'] / df['Lestablishments']
+    df['sjc'] = df['opening_job_gains'].astype('float64') / (df['population'].astype('float64') / 1000)
+    df['ssr'] = df['establishments'].astype('float64') / df['Lestablishments'].astype('float64')
 
     # Remove SJC and SSR for non-total categories
     df.loc[df.category != 'Total', ['sjc', 'ssr']] = np.NaN
 
-    # Create index variable
-    df = _index_create(df, region)
-
     return df
 
 
+@stage_cache(code=[h.se_columns])
 def _final_data_transform(df):
-    """Format the KESE data for download."""
+    """Format the KESE data for download, with the standard errors of RNE and OSE if the raw data has them."""
     return df.\
         rename(columns={'region': 'name', 'time': 'year'}).\
         sort_values(['fips', 'year', 'category']).\
         reset_index(drop=True) \
-        [['fips', 'name', 'type', 'category', 'year', 'rne', 'ose', 'sjc', 'ssr', 'zindex']]
+        [
+            ['fips', 'name', 'type', 'category', 'year', 'rne', 'ose', 'sjc', 'ssr', 'zindex'] +
+            [col for col in h.se_columns if col in df.columns]
+        ]
+
+
+def _pipeline(fetch_data, regions):
+    """
+    Transform raw KESE data to final format. Return dataframe of transformed data.
 
+    The stages of all geographical levels run concurrently as a DAG. The only dependency between the
+    levels is the US-level index baseline, which the index step of the other levels waits on.
 
-def _region_all_pipeline(region):
-    """Transform raw KESE data to final format. Return dataframe of transformed data."""
-    return _raw_data_merge(region).\
+    Parameters
+    ----------
+    fetch_data : bool
+        When true, code fetches the raw data from source; otherwise, it uses the data in data/raw_data.
+
+    regions : list
+        Geographical levels of data. Options: the keys of c.geographies
+    """
+    tasks = {
+        'cps': (lambda r: _raw_data_fetch_cps(fetch_data), []),
+        'baseline': (lambda r: _index_baseline(r['indicators_us']), ['indicators_us'])
+    }
+    for region in regions:
+        tasks.update({
+            f'fetch_{region}': (lambda r, region=region: _raw_data_fetch_region(region, fetch_data), []),
+            f'merge_{region}': (
+                lambda r, region=region: _raw_data_merge(region).pipe(_merged_validate, region),
+                (['cps'] if c.geographies[region]['cps'] else []) + [f'fetch_{region}']
+            ),
+            f'indicators_{region}': (
+                lambda r, region=region: _indicators_create(r[f'merge_{region}'], region),
+                [f'merge_{region}']
+            ),
+            f'index_{region}': (
+                lambda r, region=region: _index_create(r[f'indicators_{region}'], *r['baseline']).\
+                    pipe(_final_data_transform),
+                [f'indicators_{region}', 'baseline']
+            )
+        })
+    results = h.dag_run(tasks, max_workers=c.pipeline_workers)
+
+    return pd.concat([results[f'index_{region}'] for region in regions], axis=0)
+
+
+def _changed_years(df, df_old):
+    """Return the years whose rows differ between two versions of the merged raw data."""
+    def _rows(x):
+        x = x[df.columns]
+        return pd.Index(zip(x['time'], pd.util.hash_pandas_object(x, index=False)))
+
+    return {time for time, _ in _rows(df).symmetric_difference(_rows(df_old))}
+
+
+def _region_incremental_pipeline(region, snapshot, baseline=None):
+    """
+    Transform raw KESE data to final format, recomputing only the years whose raw data changed since
+    the snapshot of the previous run.
+
+    A changed year also changes the 3 year trailing averages of the two years that follow it, so those
+    are recomputed as well, from a window that includes the two years before each recomputed year. If
+    the US-level baseline of the index changes, the index is recomputed for every year. If the merged
+    raw data gained or lost columns since the snapshot, every year is recomputed.
+
+    Parameters
+    ----------
+    region : str
+        Geographical level of data. Options: the keys of c.geographies
+
+    snapshot : dict
+        The merged raw data, indicators data, and index baseline of the previous run. Updated in place.
+
+    baseline : tuple
+        The US-level index baseline. Required when region is 'state'.
+
+    Returns
+    -------
+    DataFrame
+        The transformed data
+    """
+    df_merged = _raw_data_merge(region).pipe(_merged_validate, region)
+    years = set(df_merged['time'])
+
+    # A snapshot whose columns differ, e.g. from before the raw data had standard errors, is rebuilt in full
+    if region in snapshot and set(snapshot[region]['merged'].columns) == set(df_merged.columns):
+        changed = _changed_years(df_merged, snapshot[region]['merged'])
+        df_old = snapshot[region]['indicators']
+    else:
+        changed = years
+        df_old = df_merged.iloc[:0]
+    affected = sorted({year + lag for year in changed for lag in range(3)} & years)
+    window = {year - lag for year in affected for lag in range(3)}
+    kp.log(f'\t{region}: recomputing years {affected}')
+
+    df_old = df_old[~df_old['time'].isin(changed.union(affected))]
+    if affected:
+        df_new = df_merged[df_merged['time'].isin(window)].\
+            copy().\
             pipe(_indicators_create, region).\
-            pipe(_final_data_transform)
+            query('time in @affected')
+    else:
+        df_new = df_old.iloc[:0]
 
+    if region == 'us':
+        baseline = _index_baseline(pd.concat([df_old, df_new]))
+    baseline_changed = 'baseline' not in snapshot or \
+        not all(new.equals(old) for new, old in zip(baseline, snapshot['baseline']))
 
-def _download_csv_save(df, aws_filepath):
-    """Save download-version of data to a csv."""
-    df.to_csv(c.filenamer('data/kcr_calc_2021_kese_download.csv'), index=False)
-    if aws_filepath:
-        df.to_csv(f'{aws_filepath}/kcr_calc_2021_kese_download.csv', index=False)
-    return df
+    if baseline_changed:
+        kp.log(f'\t{region}: index baseline changed, recomputing the index for all years')
+        df = pd.concat([df_old, df_new]).pipe(_index_create, *baseline)
+    else:
+        df = pd.concat([df_old, df_new.pipe(_index_create, *baseline)])
+
+    snapshot[region] = {'merged': df_merged, 'indicators': df}
+    return df.pipe(_final_data_transform), baseline
+
+
+def _incremental_pipeline(regions):
+    """Transform raw KESE data to final format, reusing the results of the previous run where possible."""
+    import joblib
+    snapshot_path = c.filenamer('data/snapshot/kese_snapshot.pkl')
+    snapshot = joblib.load(snapshot_path) if os.path.isfile(snapshot_path) else {}
+
+    df_us, baseline = _region_incremental_pipeline('us', snapshot)
+    df_regions = [df_us] + [
+        _region_incremental_pipeline(region, snapshot, baseline)[0] for region in regions if region != 'us'
+    ]
+    snapshot['baseline'] = baseline
 
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    joblib.dump(snapshot, snapshot_path)
+    return pd.concat(df_regions, axis=0)
 
-def _download_to_alley_formatter(df, outcome):
+
+def _download_to_alley_formatter(df, outcomes):
     """
-    Format data of a given outcome to be suitable for upload to the Kauffman website.
+    Format data to be suitable for upload to the Kauffman website. All outcomes are reshaped in a
+    single pass into one (fips, type, category) x (outcome, year) table, from which the table of each
+    outcome is taken with _alley_outcome.
 
     Parameters
     ----------
     df : DataFrame
         The data to be formatted
 
-    outcome : str
-        The column name of the outcome whose values become the cells of the dataframe
+    outcomes : list
+        The column names of the outcomes whose values become the cells of the dataframe
 
     Returns
     -------
     DataFrame
-        Formatted data
+        Formatted data, with an index of region, demographic-type, and demographic, and columns of
+        outcome and year
     """
+    return df.\
+        set_index(['fips', 'type', 'category', 'year']) \
+        [outcomes].\
+        unstack('year').\
+        sort_index().\
+        rename(index={'Total': ''}).\
+        rename_axis(['region', 'demographic-type', 'demographic'])
+
 
-    return df[['fips', 'year', 'type', 'category'] + [outcome]].\
-        pipe(pd.pivot_table, index=['fips', 'type', 'category'], columns='year', values=outcome).\
-        reset_index().\
-        replace('Total', '').\
-        rename(columns={'type': 'demographic-type', 'category': 'demographic', 'fips': 'region'})
+def _alley_outcome(df, outcome):
+    """Return the website table of one outcome from _download_to_alley_formatter, without empty rows and years."""
+    df_out = df[outcome]
+    present = df_out.notna()
+    return df_out.loc[present.any(axis=1), present.any(axis=0)]
 
 
-def _website_csvs_save(df, aws_filepath):
-    """Format and save csv of data to be uploaded to the website."""
-    print(df.head())
+def _outputs_save(df, aws_filepath, output_formats, tag=c.vintage, directory=c.filenamer('data')):
+    """
+    Save the download-version of the data and the files to be uploaded to the website, named
+    kcr_calc_{tag}_kese_*, to directory and, optionally, to aws_filepath.
+    """
+    df_alley = df.pipe(_download_to_alley_formatter, ['rne', 'ose', 'sjc', 'ssr', 'zindex'])
+    frames = {f'kcr_calc_{tag}_kese_download': df}
     for indicator in ['rne', 'ose', 'sjc', 'ssr', 'zindex']:
-        df_out = df.pipe(_download_to_alley_formatter, indicator)
+        frames[f'kcr_calc_{tag}_kese_website_{indicator}'] = df_alley.pipe(_alley_outcome, indicator).reset_index()
 
-        df_out.to_csv(c.filenamer(f'data/kcr_calc_2021_kese_website_{indicator}.csv'), index=False)
-        if aws_filepath:
-            df_out.to_csv(f'{aws_filepath}/kcr_calc_2021_kese_website_{indicator}.csv', index=False)
+    h.outputs_write(frames, aws_filepath, output_formats, directory=directory)
 
 
 def _raw_data_remove(remove_data=True):
     """If remove_data set to "True", remove TEMP files."""
     if remove_data:
-        shutil.rmtree(c.filenamer('data/temp'))  # remove unwanted files
+        shutil.rmtree(h.settings['temp_dir'])  # remove unwanted files
 
 
-def kese_data_create_all(raw_data_fetch, raw_data_remove, aws_filepath=None):
+def kese_data_create_all(
+        raw_data_fetch, raw_data_remove, aws_filepath=None, incremental=False, use_cache=True,
+        regions=('us', 'state'), profile=None, output_formats=('csv',), backend='pandas'
+):
     """
     Create and save KESE data. This is the main function of kese_command.py. 
 
@@ -317,25 +547,178 @@ def kese_data_create_all(raw_data_fetch, raw_data_remove, aws_filepath=None):
         Specifies whether to delete TEMP data at the end.
 
     aws_filepath : str
-        If present, the AWS filepath at which to stash the data.
+        If present, the AWS filepath at which to stash the data. A local directory also works.
+
+    incremental : bool
+        When true, only the years whose raw data changed since the previous incremental run are
+        recomputed. The results are kept in data/snapshot for the next run.
+
+    use_cache : bool
+        When true, pipeline stages whose inputs, parameters, constants, and code are unchanged since a
+        previous run are loaded from data/cache/stages instead of being rerun.
+
+    regions : iterable
+        Geographical levels of data to be created. Options: the keys of c.geographies. The US level is
+        required, since the index of every level is based on it.
+
+    profile : str
+        None, 'cprofile' to also profile the pipeline, or 'tracemalloc' to also trace its memory
+        allocations. The run report is written to data/reports in any case.
+
+    output_formats : iterable
+        Formats of the output files. Options: c.output_formats, i.e. csv, gzip- or zstd-compressed csv,
+        and Parquet.
+
+    backend : str
+        'pandas', or 'polars' to run the transformation as one lazy Polars query plan (see
+        kese_polars.py). The polars backend always recomputes everything, so it does not support
+        incremental.
     """
-    _raw_data_fetch(raw_data_fetch)
+    if 'us' not in regions:
+        raise ValueError("regions must include 'us', the baseline of the index")
+    if backend not in ('pandas', 'polars'):
+        raise ValueError(f"backend must be 'pandas' or 'polars', not {backend!r}")
+    if backend == 'polars' and incremental:
+        raise ValueError('The polars backend does not support incremental runs')
+    kp.run_start(profile)
+    kc.settings['enabled'] = use_cache
+    if backend == 'polars':
+        from tools.kese_polars import polars_pipeline
+        _raw_data_fetch(raw_data_fetch, regions)
+        df = polars_pipeline(regions)
+    elif incremental:
+        _raw_data_fetch(raw_data_fetch, regions)
+        df = _incremental_pipeline(regions)
+    else:
+        df = _pipeline(raw_data_fetch, regions)
 
-    pd.concat(
-        [
-            _region_all_pipeline(region) for region in ['us', 'state']
-        ],
-        axis=0
-    ).\
-        pipe(_download_csv_save, aws_filepath).\
-        pipe(_website_csvs_save, aws_filepath)
+    _outputs_save(df, aws_filepath, output_formats)
 
     _raw_data_remove(raw_data_remove)
+    kp.run_report()
 
 
-if __name__ == '__main__':
-    kese_data_create_all(
-        raw_data_fetch=False,
-        raw_data_remove=True,
-        # aws_filepath='s3://emkf.data.research/indicators/kese/data_outputs/kcr_kese_calculator'
+def _vintage_raw_data_load(vintage, regions):
+    """
+    Read the raw CPS, BED, and PEP data of a vintage and save it to the Parquet store under
+    data/temp/{vintage}. The raw data of c.vintage is read from data/raw_data, and that of other
+    vintages from data/raw_data/{vintage}.
+    """
+    kp.log(f'Loading the raw data of vintage {vintage}')
+    raw_data_dir = c.filenamer('data/raw_data' if vintage == c.vintage else f'data/raw_data/{vintage}')
+    for region in regions:
+        names = (['cps'] if c.geographies[region]['cps'] else []) + ['bed_table1', 'bed_table7', 'pep']
+        for name in names:
+            df = pd.read_csv(kp.read_path(os.path.join(raw_data_dir, f'{name}_{region}.csv')))
+            h.temp_save(ks.schema_apply(df, region), _temp_name(f'{name}_{region}', vintage))
+
+
+def _batch_tag(vintage, window):
+    """Return the tag of the output files of a batch configuration, e.g. 2021_1996_2015."""
+    return f'{vintage}_{window[0]}_{window[1]}'
+
+
+def _batch_outputs_create(indicators, regions, vintage, window, aws_filepath, output_formats):
+    """Create the index of a batch configuration from the indicators of its vintage, and save its outputs."""
+    baseline = _index_baseline(indicators['us'], window)
+    df = pd.concat(
+        [_index_create(indicators[region], *baseline).pipe(_final_data_transform) for region in regions], axis=0
+    )
+    _outputs_save(
+        df, aws_filepath, output_formats, tag=_batch_tag(vintage, window), directory=c.filenamer('data/vintages')
     )
+    return df
+
+
+def kese_data_create_batch(
+        configs, raw_data_remove=True, aws_filepath=None, use_cache=True, regions=('us', 'state'), profile=None,
+        output_formats=('csv',)
+):
+    """
+    Create and save KESE data for several raw data vintages and index baseline windows in one run,
+    e.g. for revision analysis.
+
+    The raw data of each vintage is read once, and its merged data and indicators, which do not depend
+    on the baseline window, are computed once and shared by all of its configurations. The stages of
+    all configurations run concurrently as a DAG. The outputs of each configuration are written to
+    data/vintages, named kcr_calc_{vintage}_{start}_{end}_kese_*.
+
+    Parameters
+    ----------
+    configs : iterable
+        (vintage, baseline window) tuples, e.g. [(2021, (1996, 2015)), (2021, (2000, 2019))]. The raw
+        data of c.vintage is read from data/raw_data, and that of other vintages from
+        data/raw_data/{vintage}.
+
+    raw_data_remove : bool
+        Specifies whether to delete TEMP data at the end.
+
+    aws_filepath : str
+        If present, the AWS filepath at which to stash the data. A local directory also works.
+
+    use_cache : bool
+        When true, pipeline stages whose inputs, parameters, constants, and code are unchanged since a
+        previous run are loaded from data/cache/stages instead of being rerun.
+
+    regions : iterable
+        Geographical levels of data to be created. Options: the keys of c.geographies. The US level is
+        required, since the index of every level is based on it.
+
+    profile : str
+        None, 'cprofile' to also profile the run, or 'tracemalloc' to also trace its memory
+        allocations. The run report is written to data/reports in any case.
+
+    output_formats : iterable
+        Formats of the output files. Options: c.output_formats
+
+    Returns
+    -------
+    dict
+        The transformed data of each configuration, keyed by (vintage, baseline window)
+    """
+    if 'us' not in regions:
+        raise ValueError("regions must include 'us', the baseline of the index")
+    configs = list(dict.fromkeys((vintage, tuple(window)) for vintage, window in configs))
+    kp.run_start(profile)
+    kc.settings['enabled'] = use_cache
+
+    tasks = {}
+    for vintage in dict.fromkeys(vintage for vintage, _ in configs):
+        tasks[f'load_{vintage}'] = (lambda r, vintage=vintage: _vintage_raw_data_load(vintage, regions), [])
+        for region in regions:
+            tasks[f'indicators_{vintage}_{region}'] = (
+                lambda r, vintage=vintage, region=region: _raw_data_merge(region, vintage).\
+                    pipe(_merged_validate, region).\
+                    pipe(_indicators_create, region),
+                [f'load_{vintage}']
+            )
+    for vintage, window in configs:
+        tasks[_batch_tag(vintage, window)] = (
+            lambda r, vintage=vintage, window=window: _batch_outputs_create(
+                {region: r[f'indicators_{vintage}_{region}'] for region in regions},
+                regions, vintage, window, aws_filepath, output_formats
+            ),
+            [f'indicators_{vintage}_{region}' for region in regions]
+        )
+    results = h.dag_run(tasks, max_workers=c.pipeline_workers)
+
+    _raw_data_remove(raw_data_remove)
+    kp.run_report()
+    return {(vintage, window): results[_batch_tag(vintage, window)] for vintage, window in configs}
+
+
+kp.instrument_module(
+    sys.modules[__name__],
+    [
+        '_fetch_data_cps', '_fetch_data_bed', '_fetch_data_pep', '_raw_data_fetch_cps', '_raw_data_fetch_region',
+        '_raw_data_fetch', '_raw_data_merge', '_merged_validate', '_index_baseline', '_index_create',
+        '_indicators_create', '_final_data_transform', '_pipeline', '_region_incremental_pipeline',
+        '_incremental_pipeline', '_download_to_alley_formatter', '_alley_outcome', '_outputs_save',
+        '_raw_data_remove', '_vintage_raw_data_load', '_batch_outputs_create'
+    ]
+)
+
+
+if __name__ == '__main__':
+    from tools.kese_cli import main
+    main(['build'] + sys.argv[1:])
@@ -1,163 +1,767 @@
+import io
+import os
+import sys
+import gzip
+import json
+import hashlib
+import tempfile
+import urllib.error
+import urllib.request
+import numpy as np
 import pandas as pd
 import tools.constants as c
+import tools.kese_profile as kp
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+# Directory of the Parquet store of intermediate data. The benchmark points it at a temporary directory.
+settings = {
+    'temp_dir': c.filenamer('data/temp')
+}
 
-def _rne(df):
-    """Calculate the Rate of New Entrepreneurs for a given region and year."""
-    return (df['ent015ua'] * df['wgtat1']).sum() / df['wgtat1'].sum()
 
+def _category_masks(df, categories):
+    """Evaluate each category query in c.kese_category_queries once. Returns a (rows x categories) boolean matrix."""
+    return np.column_stack(
+        [df.eval(c.kese_category_queries[cat]).to_numpy(dtype=bool) for cat in categories]
+    )
 
-def _ose(df):
-    """Calculate the Opportunity Share of Entrepreneurs for a given region and year."""
-    return (df['oppshare'] * df['wgtat1']).sum() / df['wgtat1'].sum()
 
+def _replicate_sums(rows, cells, terms, n_rows, n_cells, seed, replicates, blocksize=c.cps_replicate_blocksize):
+    """
+    Calculate the weighted sums of _weighted_sums under each of a set of bootstrap replicate weights.
+
+    Replicate r reweights each row by wgtat1 * m_r, where the multipliers m_r are independent Exp(1)
+    draws: the Bayesian bootstrap, which, unlike resampling rows, can be applied to one chunk of the
+    data at a time. The sums of all replicates are the matrix product of the (cells x rows) matrix of
+    each row's terms in each cell and the (rows x replicates) matrix of multipliers, taken a block of
+    rows at a time so that only blocksize rows of multipliers are held in memory. Blocks whose group
+    matrix is mostly zeros are multiplied one cell at a time instead. The product is taken
+    in float32, whose ~1e-7 relative error is negligible against the spread of the replicates, and
+    added up across blocks in float64.
+
+    Parameters
+    ----------
+    rows : ndarray
+        Sorted row of each (row, cell) pair
+
+    cells : ndarray
+        Cell of each pair, as a position in 0 .. n_cells - 1
+
+    terms : dict
+        The term of each pair in each sum, e.g. w * x for wx_rne, keyed by the name of the sum
+
+    n_rows : int
+        Number of rows of the data. The multipliers depend only on the seed and the row, so data of
+        different geographical levels drawn with the same seed share their replicates.
 
-def preprocess_cps(df, region):
+    n_cells : int
+        Number of cells
+
+    seed : list
+        Seed of the multipliers
+
+    replicates : int
+        Number of replicates
+
+    blocksize : int
+        Number of rows multiplied at once
+
+    Returns
+    -------
+    DataFrame
+        One row per cell, with a column {sum}_{r} for each sum and replicate
     """
-    Pre-processes CPS data. Generate indicators and aggregate it to the annual level, broken down by
-    category.
+    rng = np.random.default_rng(seed)
+    out = {name: np.zeros((n_cells, replicates)) for name in terms}
+    for start in range(0, n_rows, blocksize):
+        multipliers = rng.standard_exponential((min(blocksize, n_rows - start), replicates), dtype=np.float32)
+        first, last = np.searchsorted(rows, [start, start + blocksize])
+        block_cells, positions = np.unique(cells[first:last], return_inverse=True)
+
+        if 4 * (last - first) > len(block_cells) * len(multipliers):
+            # Dense group matrix, e.g. the overlapping US-level categories: one product for the block
+            groups = np.zeros((len(terms), len(block_cells), len(multipliers)), dtype=np.float32)
+            for k, values in enumerate(terms.values()):
+                groups[k, positions, rows[first:last] - start] = values[first:last]
+            product = groups.reshape(-1, len(multipliers)) @ multipliers  # numpy's matrix product runs on all cores
+            for k, name in enumerate(terms):
+                out[name][block_cells] += product[k * len(block_cells):(k + 1) * len(block_cells)]
+        else:
+            # Sparse group matrix, e.g. one state per row: it is block diagonal once the pairs are sorted
+            # by cell, so each cell's block is multiplied by the multipliers of its own rows only
+            order = first + np.argsort(positions, kind='stable')
+            bounds = np.searchsorted(positions[order - first], np.arange(1, len(block_cells)))
+            for cell, pairs in zip(block_cells, np.split(order, bounds)):
+                groups = np.array([values[pairs] for values in terms.values()], dtype=np.float32)
+                product = groups @ multipliers[rows[pairs] - start]
+                for k, name in enumerate(terms):
+                    out[name][cell] += product[k]
+
+    return pd.DataFrame(
+        {f'{name}_{r}': values[:, r] for name, values in out.items() for r in range(replicates)}
+    )
+
+
+def _weighted_sums(df, keys, masks, seed=None, replicates=c.cps_replicates):
+    """
+    Calculate the weighted sums behind the Rate of New Entrepreneurs (RNE) and the Opportunity Share
+    of Entrepreneurs (OSE) for every combination of category and keys in a single pass.
+
+    Each indicator is the weighted mean sum(w * x) / sum(w) over the rows with non-missing x, where w
+    is wgtat1. Rows with a missing key are dropped. Sums from separate chunks of data can be added up
+    before the means are taken by _weighted_means.
 
     Parameters
     ----------
     df : DataFrame
         Raw CPS data
 
-    region : str
-        Geographical level of data to be fetched. Options: 'us' or 'state'
+    keys : list
+        Columns to group by, e.g. ['yeart1', 'state']
+
+    masks : ndarray
+        Boolean (rows x categories) matrix of category membership
+
+    seed : list
+        If present, the seed of the bootstrap replicate weights whose sums (see _replicate_sums) are
+        added for the standard errors of the indicators
+
+    replicates : int
+        Number of bootstrap replicates
 
     Returns
     -------
     DataFrame
-        The processed data
+        One row per cell with observations, with the category position in masks, the keys, and for
+        each indicator the number of observations (n_), sum(w * x) (wx_), and sum(w) (w_)
+    """
+    codes, uniques = zip(*[pd.factorize(df[key], sort=True) for key in keys])
+    shape = (masks.shape[1],) + tuple(len(u) for u in uniques)
+    n_cells = int(np.prod(shape))
+
+    rows, cats = np.nonzero(masks & np.all([code >= 0 for code in codes], axis=0)[:, None])
+    cells = np.ravel_multi_index((cats,) + tuple(code[rows] for code in codes), shape)
+
+    # pandas' sum skips missing weights in both the numerator and the denominator
+    w = df['wgtat1'].to_numpy(dtype=float)[rows]
+    w[np.isnan(w)] = 0
+
+    sums = {}
+    terms = {}
+    for indicator, col in [('rne', 'ent015ua'), ('ose', 'oppshare')]:
+        x = df[col].to_numpy(dtype=float)[rows]
+        valid = ~np.isnan(x)
+        sums[f'n_{indicator}'] = np.bincount(cells[valid], minlength=n_cells)
+        sums[f'wx_{indicator}'] = np.bincount(cells[valid], weights=x[valid] * w[valid], minlength=n_cells)
+        sums[f'w_{indicator}'] = np.bincount(cells[valid], weights=w[valid], minlength=n_cells)
+        terms[f'wx_{indicator}'] = np.where(valid, x * w, 0)
+        terms[f'w_{indicator}'] = np.where(valid, w, 0)
+
+    occupied = np.flatnonzero((sums['n_rne'] > 0) | (sums['n_ose'] > 0))
+    index = np.unravel_index(occupied, shape)
+    df_sums = pd.DataFrame(
+        dict(
+            {'category_code': index[0]},
+            **{key: u[i] for key, u, i in zip(keys, uniques, index[1:])},
+            **{name: values[occupied] for name, values in sums.items()}
+        )
+    )
+    if seed is None:
+        return df_sums
+
+    # Pairs without observations of either indicator add nothing, and their cells may not be occupied
+    observed = np.any([values != 0 for values in terms.values()], axis=0)
+    df_replicates = _replicate_sums(
+        rows[observed], np.searchsorted(occupied, cells[observed]),
+        {name: values[observed] for name, values in terms.items()}, len(df), len(occupied), seed, replicates
+    )
+    return pd.concat([df_sums, df_replicates], axis=1)
+
+
+def _replicate_se(df, indicator):
+    """Calculate the standard error of an indicator as the standard deviation of its bootstrap replicates."""
+    wx = df.filter(regex=rf'^wx_{indicator}_\d+$').to_numpy()
+    w = df.filter(regex=rf'^w_{indicator}_\d+$').to_numpy()
+    return (wx / w).std(axis=1, ddof=1)
+
+
+def _weighted_means(df):
+    """
+    Calculate RNE and OSE from weighted sums, and their standard errors if the sums include bootstrap
+    replicates. Only cells with observations for both indicators are kept.
     """
-    df.query('yeart1 == yeart1', inplace=True)
-    print('\tPre-processing data for', region, df['yeart1'].unique())
+    df = df.\
+        query('n_rne > 0 and n_ose > 0').\
+        assign(
+            rne=lambda x: x['wx_rne'] / x['w_rne'],
+            ose=lambda x: x['wx_ose'] / x['w_ose']
+        )
+    if 'wx_rne_0' in df.columns:
+        df = df.assign(rne_se=lambda x: _replicate_se(x, 'rne'), ose_se=lambda x: _replicate_se(x, 'ose'))
+    return df
+
+
+_categories = [(type_c, cat) for type_c in c.kese_categories for cat in c.kese_categories[type_c]]
+se_columns = ['rne_se', 'ose_se']
+_cps_keys = {'us': ['category_code', 'yeart1'], 'state': ['category_code', 'yeart1', 'state']}
+
+
+def _cps_sums(df, region, seed=None):
+    """Calculate the weighted sums of CPS data for a given geographical level, with bootstrap replicates if seeded."""
+    df = df[df['yeart1'].notna()]
+    if region == 'state':
+        return _weighted_sums(df, ['yeart1', 'state'], np.ones((len(df), 1), dtype=bool), seed)
+    else:
+        return _weighted_sums(df, ['yeart1'], _category_masks(df, [cat for _, cat in _categories]), seed)
+
+
+def _cps_format(df, region):
+    """Generate the indicators from the weighted sums of CPS data and format them."""
+    df = df.\
+        sort_values(_cps_keys[region]).\
+        pipe(_weighted_means)
 
     if region == 'state':
-        df_rne = df \
-            [~df.ent015ua.isna()].\
-            groupby(['yeart1', 'state']).apply(_rne).\
-            reset_index(name='rne')\
-            [['yeart1', 'state', 'rne']]
-
-        df_ose = df \
-            [~df.oppshare.isna()].\
-            groupby(['yeart1', 'state']).apply(_ose).\
-            reset_index(name='ose')\
-            [['yeart1', 'state', 'ose']]
-
-        df_processed = df_rne.\
-            merge(df_ose).\
+        df_processed = df.\
             assign(
                 category='Total',
                 type='Total',
                 fips=lambda x: x.state.map(c.cps_to_fips),
                 region=lambda x: x['fips'].map(c.state_fips_abb_dic).map(c.abbrev_us_state)
-            ).\
-            drop('state', 1)
-
-    else:
-        df_processed = pd.DataFrame()
-        for type_c in c.kese_categories:
-            for cat in c.kese_categories[type_c]:
-                df_rne = df \
-                    [~df.ent015ua.isna()].\
-                    query(c.kese_category_queries[cat]).\
-                    groupby('yeart1').apply(_rne).\
-                    reset_index(name='rne') \
-                    [['yeart1', 'rne']]
-
-                df_ose = df \
-                    [~df.oppshare.isna()].\
-                    query(c.kese_category_queries[cat]).\
-                    groupby('yeart1').apply(_ose).\
-                    reset_index(name='ose') \
-                    [['yeart1', 'ose']]
-
-                df_processed = df_processed.\
-                    append(
-                        df_rne.\
-                            merge(df_ose).\
-                            assign(
-                                type=type_c,
-                                category=cat,
-                                fips='00'
-                            )
-                    ).\
-                    assign(region='United States')
+            )
 
-    return df_processed. \
-        rename(columns={'yeart1': 'time'}).\
-        astype({'time': 'int'}) \
-        [['fips', 'region', 'type', 'category', 'time', 'rne', 'ose']]
-
-
-def pep_pre_2000(region):
-    """Fetch population data for years: 1996 - 1999."""
-    return pd.read_excel('http://www2.census.gov/library/publications/2011/compendia/statab/131ed/tables/12s0013.xls?', skiprows=3, skipfooter=9).\
-        rename(columns={'State': 'region'}). \
-        query('region not in ["Northeast", "Midwest", "South", "West "]') \
-        [['region'] + [str(year) + " (July)" for year in range(1996, 2000)]].\
-        query('region == "  United States "' if region == 'us' else 'region != "  United States "'). \
-        rename(columns=lambda x: int(x[0:4]) if x != 'region' else x).\
-        pipe(pd.melt, id_vars='region', value_vars=range(1996, 2000), var_name='time', value_name='population').\
-        assign(
-            region=lambda x: x.region.str.strip(),
-            fips=lambda x: x.region.map(c.us_state_abbrev).map(c.state_abb_fips_dic),
-            population=lambda x: x['population'] * 1000
-        ).\
-        astype({'time': 'int'}) \
-        [['fips', 'region', 'time', 'population']]
-
-
-def pep_2020(region):
-    """Fetch population data for 2020."""
-    if region == 'us':
-        return pd.read_excel('https://www2.census.gov/programs-surveys/popest/tables/2010-2019/national/totals/na-est2019-01.xlsx', skiprows=2, usecols=['Year and Month', 'Resident Population']).\
-            iloc[128:139, :].\
-            rename(columns={'Year and Month':'time', 'Resident Population': 'population'}).\
-            query('time == ".July 1"').\
-            assign(
-                time=2020,
-                fips='00',
-                region='United States'
-            ) \
-            [['fips', 'region', 'time', 'population']]
     else:
-        return pd.read_excel('https://www2.census.gov/programs-surveys/popest/tables/2010-2020/state/totals/nst-est2020.xlsx', skiprows=3, skipfooter=5).\
-            rename(columns={'Unnamed: 0': 'region', 'July 1': 'population'}) \
-            [['region', 'population']].\
-            query('region not in ["Northeast", "Midwest", "South", "West", "United States"]').\
-            dropna().\
-            assign(
-                region=lambda x: x.region.apply(lambda x: x.strip('.')),
-                fips=lambda x: x.region.map(c.us_state_abbrev).map(c.state_abb_fips_dic),
-                time=2020
-            ) \
-            [['fips', 'region', 'time', 'population']]
-
-def pep_2021(region):
-    """Fetch population data for 2021."""
-    if region == 'us':
-        return pd.read_excel('https://www2.census.gov/programs-surveys/popest/tables/2020-2021/national/totals/NA-EST2021-POP.xlsx', skiprows=2, usecols=['Year and Month', 'Resident Population']).\
-            iloc[11:23, :].\
-            rename(columns={'Year and Month':'time', 'Resident Population': 'population'}).\
-            query('time == ".July 1"').\
+        types, cats = zip(*_categories)
+        df_processed = df.\
             assign(
-                time=2021,
+                type=lambda x: np.array(types)[x['category_code']],
+                category=lambda x: np.array(cats)[x['category_code']],
                 fips='00',
                 region='United States'
-            ) \
-            [['fips', 'region', 'time', 'population']]
+            )
+
+    return df_processed. \
+        rename(columns={'yeart1': 'time'}).\
+        astype({'time': 'int'}).\
+        reset_index(drop=True) \
+        [['fips', 'region', 'type', 'category', 'time', 'rne', 'ose'] + [col for col in se_columns if col in df.columns]]
+
+
+def preprocess_cps(df, region, seed=None):
+    """
+    Pre-processes CPS data. Generate indicators and aggregate it to the annual level, broken down by
+    category.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Raw CPS data
+
+    region : str
+        Geographical level of data to be fetched. Options: 'us' or 'state'
+
+    seed : list
+        If present, the seed of c.cps_replicates bootstrap replicate weights, from which the standard
+        errors rne_se and ose_se are calculated
+
+    Returns
+    -------
+    DataFrame
+        The processed data
+    """
+    kp.log(f"\tPre-processing data for {region} {df['yeart1'].dropna().unique()}")
+    return _cps_sums(df, region, seed).pipe(_cps_format, region)
+
+
+def preprocess_cps_chunks(chunks, seed=None):
+    """
+    Pre-processes CPS data read in chunks, e.g. by read_cps. The weighted sums of each chunk are added
+    up as the chunks are read, so memory use depends on the size of a chunk rather than of the data.
+
+    Parameters
+    ----------
+    chunks : iterable
+        DataFrames of raw CPS data
+
+    seed : list
+        If present, the seed of c.cps_replicates bootstrap replicate weights, from which the standard
+        errors rne_se and ose_se are calculated. Each chunk draws its weights from the seed and its
+        position.
+
+    Returns
+    -------
+    tuple
+        The processed US- and state-level data
+    """
+    sums = {'us': [], 'state': []}
+    for i, chunk in enumerate(chunks):
+        for region in sums:
+            sums[region].append(_cps_sums(chunk, region, None if seed is None else list(seed) + [i]))
+
+    return tuple(
+        pd.concat(sums[region]).\
+            groupby(_cps_keys[region], as_index=False).sum().\
+            pipe(_cps_format, region)
+        for region in sums
+    )
+
+
+def read_cps(path, chunksize=c.cps_chunksize):
+    """Read the columns of CPS microdata used by the indicators, with compact dtypes, in chunks."""
+    return pd.read_csv(kp.read_path(path), usecols=list(c.cps_dtypes), dtype=c.cps_dtypes, chunksize=chunksize)
+
+
+def atomic_write(path, data):
+    """Write bytes to path via a temporary file, so readers never see a partially written file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    kp.record_io(written=len(data))
+
+
+def _output_serialize(df, fmt, csv=None):
+    """Serialize a DataFrame to bytes in one of c.output_formats. csv is the already serialized csv, if any."""
+    if fmt == 'parquet':
+        buffer = io.BytesIO()
+        df.rename(columns=str).to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+    csv = csv if csv is not None else df.to_csv(index=False).encode()
+    if fmt == 'csv.gz':
+        return gzip.compress(csv, mtime=0)
+    if fmt == 'csv.zst':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(csv)
+    return csv
+
+
+def _output_copy(path, data):
+    """Write bytes to a local path, or to a remote one (e.g. s3://...) through fsspec."""
+    if '://' not in path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, data)
+        return
+
+    import fsspec
+    with fsspec.open(path, 'wb') as f:
+        f.write(data)
+    kp.record_io(written=len(data))
+
+
+def _output_write(df, name, dirs, formats):
+    """Serialize one output in each format and write every copy of it from the same bytes."""
+    csv = df.to_csv(index=False).encode() if any(fmt.startswith('csv') for fmt in formats) else None
+    for fmt in formats:
+        data = _output_serialize(df, fmt, csv)
+        for directory in dirs:
+            _output_copy(f'{directory}/{name}.{fmt}', data)
+
+
+def outputs_write(
+        frames, aws_filepath=None, formats=('csv',), max_workers=c.output_workers, directory=c.filenamer('data')
+):
+    """
+    Write output datasets to a local directory and, optionally, to a second location. Each dataset is serialized
+    once per format, and every copy is written from the same bytes. Datasets are written concurrently.
+
+    Parameters
+    ----------
+    frames : dict
+        The datasets to be written, keyed by file name without extension
+
+    aws_filepath : str
+        If present, the directory, local or remote (e.g. s3://...), at which to stash a second copy
+
+    formats : iterable
+        File formats to be written. Options: c.output_formats
+
+    max_workers : int
+        Maximum number of datasets written at once
+
+    directory : str
+        The local directory to which the datasets are written
+    """
+    unknown = set(formats) - set(c.output_formats)
+    if unknown:
+        raise ValueError(f'Unknown output formats {sorted(unknown)}. Options: {c.output_formats}')
+
+    dirs = [directory] + ([aws_filepath.rstrip('/')] if aws_filepath else [])
+    parent = kp.context()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(kp.in_context, parent, _output_write, df, name, dirs, formats) for name, df in frames.items()
+        ]
+    for future in futures:
+        future.result()
+
+
+def cached_download(url, cache_dir=c.filenamer('data/cache/cps')):
+    """
+    Download a file into a local content-addressed cache. Files are stored under the sha256 of their
+    content, and cached copies are revalidated against the server with ETag/Last-Modified headers.
+
+    Parameters
+    ----------
+    url : str
+        Location of the file
+
+    cache_dir : str
+        Directory of the cache
+
+    Returns
+    -------
+    str
+        Path to the cached copy of the file
+    """
+    os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, 'meta'), exist_ok=True)
+    meta_path = os.path.join(cache_dir, 'meta', hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    meta = {}
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    object_path = os.path.join(cache_dir, 'objects', meta.get('sha256', ''))
+
+    request = urllib.request.Request(url)
+    if os.path.isfile(object_path):
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+
+    # The file is streamed into a temporary file in the cache, so that only a chunk of it is in memory
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.join(cache_dir, 'objects'), suffix='.tmp')
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f, urllib.request.urlopen(request) as response:
+            headers = response.headers
+            for chunk in iter(lambda: response.read(c.download_chunksize), b''):
+                sha256.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except urllib.error.HTTPError as e:
+        os.remove(tmp_path)
+        if e.code == 304:
+            return object_path
+        raise
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    kp.record_io(read=size)
+
+    object_path = os.path.join(cache_dir, 'objects', sha256.hexdigest())
+    if os.path.isfile(object_path):
+        os.remove(tmp_path)
     else:
-        return pd.read_excel('https://www2.census.gov/programs-surveys/popest/tables/2020-2021/state/totals/NST-EST2021-POP.xlsx', skiprows=3, skipfooter=5).\
-            rename(columns={'Unnamed: 0': 'region', 2021: 'population'}) \
-            [['region', 'population']].\
-            query('region not in ["Northeast", "Midwest", "South", "West", "United States"]').\
-            dropna().\
-            assign(
-                region=lambda x: x.region.apply(lambda x: x.strip('.')),
-                fips=lambda x: x.region.map(c.us_state_abbrev).map(c.state_abb_fips_dic),
-                time=2021
-            ) \
-            [['fips', 'region', 'time', 'population']]
+        os.replace(tmp_path, object_path)
+        kp.record_io(written=size)
+    atomic_write(
+        meta_path,
+        json.dumps(
+            {
+                'url': url, 'sha256': sha256.hexdigest(), 'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')
+            }
+        ).encode()
+    )
+    return object_path
+
+
+def temp_path(name):
+    """Return the path of a dataset in the Parquet store in settings['temp_dir'], data/temp by default."""
+    return os.path.join(settings['temp_dir'], f'{name}.parquet')
+
+
+def temp_save(df, name):
+    """
+    Save a dataset to the Parquet store in data/temp. The file is written under a temporary name and
+    then moved into place, so a concurrent or later reader never sees a partially written file.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data to be saved
+
+    name : str
+        Name of the dataset, e.g. 'bed_table7_state'
+    """
+    path = temp_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    kp.written_path(path)
+
+
+def temp_load(name, columns=None, filters=None):
+    """
+    Load a dataset from the Parquet store in data/temp, reading only the requested columns and rows.
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset, e.g. 'bed_table7_state'
+
+    columns : list
+        Columns to read. All columns are read if None.
+
+    filters : list
+        Row filters pushed down to the Parquet reader, e.g. [('firm_age', '==', 1)]
+
+    Returns
+    -------
+    DataFrame
+        The data
+    """
+    path = kp.read_path(temp_path(name))
+    return pd.read_parquet(path, columns=columns, filters=filters)
+
+
+def _cps_year(year, url, cache_dir):
+    """Download and pre-process the CPS microdata of a single year."""
+    kp.log(f'\tPre-processing data for {year}')
+    return preprocess_cps_chunks(
+        read_cps(cached_download(url.format(year=year), cache_dir)), seed=[c.cps_replicate_seed, year]
+    )
+
+
+def cps_fetch(
+        years=c.cps_years, url=c.cps_microdata_url, cache_dir=c.filenamer('data/cache/cps'),
+        max_workers=c.cps_fetch_workers
+):
+    """
+    Fetch CPS microdata and pre-process it, one year per worker.
+
+    Parameters
+    ----------
+    years : iterable
+        Years of microdata to fetch
+
+    url : str
+        Location of the microdata, with a {year} placeholder
+
+    cache_dir : str
+        Directory of the download cache
+
+    max_workers : int
+        Maximum number of years fetched and pre-processed at once
+
+    Returns
+    -------
+    tuple
+        The pre-processed US- and state-level data
+    """
+    parent = kp.context()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        df_us, df_state = zip(*pool.map(lambda year: kp.in_context(parent, _cps_year, year, url, cache_dir), years))
+    return pd.concat(df_us, ignore_index=True), pd.concat(df_state, ignore_index=True)
+
+
+def categorical_keys(frames, col):
+    """
+    Convert a key column of several frames to one shared categorical dtype. Merges and groupbys on the
+    column then compare integer codes, and each distinct key is stored once.
+
+    Parameters
+    ----------
+    frames : list
+        DataFrames with the column col
+
+    col : str
+        The key column, e.g. 'fips'
+
+    Returns
+    -------
+    list
+        The frames, with col converted
+    """
+    dtype = pd.CategoricalDtype(sorted(set().union(*[frame[col].unique() for frame in frames])))
+    return [frame.astype({col: dtype}) for frame in frames]
+
+
+def _encoded_key(df, key, time, t0, span):
+    """Encode (key, time) pairs as integers, from the categorical codes of key and the offset of time from t0."""
+    return df[key].cat.codes.to_numpy('int64') * span + (df[time].to_numpy('int64') - t0)
+
+
+def keyed_join(df, tables, key='fips', time='time'):
+    """
+    Left join lookup tables onto df by (key, time), e.g. (fips, year). Each table is sorted once on an
+    integer encoding of its (key, time) pairs; the rows matching df are found by binary search and
+    gathered with one take per column, so no intermediate frames are built.
+
+    Like merge(how='left', validate='many_to_one'), every table must have at most one row per
+    (key, time), so a join can never multiply the rows of df.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data to be enriched
+
+    tables : list
+        DataFrames with the columns key and time, and the columns to be added to df. key must have the
+        same categorical dtype in df and in every table (see categorical_keys).
+
+    key : str
+        The categorical key column
+
+    time : str
+        The integer year column
+
+    Returns
+    -------
+    DataFrame
+        df, with the columns of the tables added
+    """
+    t0 = min(frame[time].min() for frame in [df] + tables)
+    span = max(frame[time].max() for frame in [df] + tables) - t0 + 1
+    keys = _encoded_key(df, key, time, t0, span)
+
+    columns = {}
+    for table in tables:
+        table_keys = _encoded_key(table, key, time, t0, span)
+        order = np.argsort(table_keys, kind='stable')
+        table_keys = table_keys[order]
+        if (table_keys[1:] == table_keys[:-1]).any():
+            raise ValueError(f'Lookup table has more than one row per ({key}, {time}): {list(table.columns)}')
+
+        rows = np.full(len(keys), -1)
+        if len(table_keys):
+            positions = np.searchsorted(table_keys, keys).clip(max=len(table_keys) - 1)
+            rows = np.where(table_keys[positions] == keys, order[positions], -1)
+
+        for col in table.columns.drop([key, time]):
+            if col in df.columns or col in columns:
+                raise ValueError(f'Column {col} is in more than one of the joined frames')
+            columns[col] = pd.api.extensions.take(table[col].array, rows, allow_fill=True)
+
+    return df.assign(**columns)
+
+
+def rolling_mean(df, keys, cols, window=3, time='time'):
+    """
+    Calculate trailing means over consecutive years within each group, in time linear in the number of
+    rows. A mean is only generated when every year of the window is present and non-missing, so gaps
+    in the years are never averaged across.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data
+
+    keys : list
+        Columns identifying each group, e.g. ['fips', 'category']
+
+    cols : list
+        Columns to average
+
+    window : int
+        Number of years in the window, including the current year
+
+    time : str
+        Column with the year
+
+    Returns
+    -------
+    DataFrame
+        The trailing means, aligned with the index of df
+    """
+    group = df.groupby(keys, sort=False, observed=True).ngroup().to_numpy()
+    order = np.lexsort((df[time].to_numpy(), group))
+    group = group[order]
+    years = df[time].to_numpy()[order]
+    values = df[cols].to_numpy(dtype=float)[order]
+
+    # Add up the window from the oldest year to the current one, like pandas' rolling
+    total = np.full(values.shape, np.nan)
+    complete = np.zeros(len(df), dtype=bool)
+    total[window - 1:] = values[:len(df) - window + 1]
+    complete[window - 1:] = (group[window - 1:] == group[:len(df) - window + 1]) & \
+        (years[window - 1:] - years[:len(df) - window + 1] == window - 1)
+    for lag in reversed(range(window - 1)):
+        total[lag:] += values[:len(df) - lag]
+
+    means = np.empty(values.shape)
+    means[order] = np.where(complete[:, None], total / window, np.nan)
+    return pd.DataFrame(means, index=df.index, columns=cols)
+
+
+def rolling_se(df, keys, cols, window=3, time='time'):
+    """
+    Calculate the standard errors of the trailing means of rolling_mean from the standard errors of the
+    yearly values, treating the years as independent samples: sqrt(sum(se ** 2)) / window.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data
+
+    keys : list
+        Columns identifying each group, e.g. ['fips', 'category']
+
+    cols : list
+        Columns of standard errors, e.g. ['rne_se', 'ose_se']
+
+    window : int
+        Number of years in the window, including the current year
+
+    time : str
+        Column with the year
+
+    Returns
+    -------
+    DataFrame
+        The standard errors, aligned with the index of df
+    """
+    return np.sqrt(rolling_mean(df.assign(**{col: df[col] ** 2 for col in cols}), keys, cols, window, time) / window)
+
+
+def dag_run(tasks, max_workers=None):
+    """
+    Run a DAG of tasks on a thread pool. Each task starts as soon as the tasks it depends on have
+    finished.
+
+    Parameters
+    ----------
+    tasks : dict
+        Maps the name of each task to a tuple (func, dependencies). func is called with a dict of the
+        results of the finished tasks; dependencies is a list of the names of the tasks it needs.
+
+    max_workers : int
+        Maximum number of tasks run at once
+
+    Returns
+    -------
+    dict
+        The result of each task
+    """
+    pending = dict(tasks)
+    running = {}
+    results = {}
+    parent = kp.context()  # the tasks' instrumented calls are nested in this one, though run on the pool
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, (func, dependencies) in list(pending.items()):
+                if all(dependency in results for dependency in dependencies):
+                    running[pool.submit(kp.in_context, parent, func, dict(results))] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f'Tasks {list(pending)} have missing or circular dependencies')
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+kp.instrument_module(
+    sys.modules[__name__],
+    [
+        'preprocess_cps', 'preprocess_cps_chunks', 'read_cps', 'outputs_write', '_output_write', 'cached_download',
+        'temp_save', 'temp_load', '_cps_year', 'cps_fetch', 'keyed_join', 'rolling_mean', 'rolling_se', 'dag_run'
+    ]
+)
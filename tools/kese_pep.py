@@ -0,0 +1,154 @@
+import os
+import sys
+import hashlib
+import inspect
+import functools
+import tempfile
+import pandas as pd
+import tools.constants as c
+import tools.kese_helpers as h
+import tools.kese_profile as kp
+from concurrent.futures import ThreadPoolExecutor
+
+columns = {'fips': 'str', 'region': 'str', 'time': 'int16', 'population': 'float64'}
+
+
+def _name_fips(names):
+    """Map the names of states, or of the United States, to fips codes."""
+    return names.map(c.us_state_abbrev).map(c.state_abb_fips_dic)
+
+
+def _statab_parse(path, region, years):
+    """Parse the 1996 - 1999 population estimates of the Statistical Abstract, in thousands."""
+    year_columns = {f'{year} (July)': year for year in range(years[0], years[1] + 1)}
+    return pd.read_excel(path, skiprows=3, skipfooter=9).\
+        rename(columns={'State': 'region'}).\
+        query('region not in ["Northeast", "Midwest", "South", "West "]') \
+        [['region'] + list(year_columns)].\
+        query('region == "  United States "' if region == 'us' else 'region != "  United States "').\
+        rename(columns=year_columns).\
+        melt(id_vars='region', value_vars=list(year_columns.values()), var_name='time', value_name='population').\
+        assign(
+            region=lambda x: x['region'].str.strip(),
+            fips=lambda x: _name_fips(x['region']),
+            population=lambda x: (x['population'] * 1000).round()
+        )
+
+
+def _kauffman_pep(region, years):
+    """Fetch population estimates from the Census API through the kauffman library."""
+    from kauffman.data import pep
+    return pep(region).\
+        rename(columns={'POP': 'population'}).\
+        astype({'time': 'int', 'population': 'int'}).\
+        query('time >= @years[0]' if years[1] is None else '@years[0] <= time <= @years[1]')
+
+
+# Sources of the population estimates, by the first and last years they cover (None for open-ended). Each
+# source contributes only its own years, and the years of the sources of a geographical level must not
+# overlap. Sources with urls are downloaded and parsed with parse(path, region, years); a url may be a
+# local file:// path, e.g. a fixture spreadsheet. The others are fetched with fetch(region, years).
+sources = [
+    {
+        'name': 'pep',
+        'years': (2000, None),
+        'fetch': _kauffman_pep
+    },
+    {
+        'name': 'statab_1996_1999',
+        'years': (1996, 1999),
+        'urls': {
+            region: 'http://www2.census.gov/library/publications/2011/compendia/statab/131ed/tables/12s0013.xls?'
+            for region in c.geographies if c.geographies[region]['pep_pre_2000']
+        },
+        'parse': _statab_parse
+    }
+]
+
+
+def _typed(df):
+    """Select and type the columns of a population frame."""
+    return df[list(columns)].astype(columns)
+
+
+def _parse_source(parse):
+    """The source code of a parser, with the arguments bound by functools.partial, for the cache key."""
+    if isinstance(parse, functools.partial):
+        return f'{_parse_source(parse.func)} {parse.args!r} {parse.keywords!r}'
+    return inspect.getsource(parse)
+
+
+def _source_load(source, region, cache_dir):
+    """
+    Load the estimates of one source. Downloaded files are parsed once: the parsed frame is cached as
+    Parquet under the hash of the url and the source code of the parser, and the checksum of the file,
+    and reparsed only when the file or the parser changes.
+    """
+    if 'urls' not in source:
+        return _typed(source['fetch'](region, source['years']))
+
+    url = source['urls'][region]
+    path = h.cached_download(url, os.path.join(cache_dir, 'downloads'))
+    checksum = os.path.basename(path)  # downloads are stored under the sha256 of their content
+    parse = source['parse'][region] if isinstance(source['parse'], dict) else source['parse']
+    key = hashlib.sha1(f"{url} {source['years']} {_parse_source(parse)}".encode()).hexdigest()[:12]
+    parsed_path = os.path.join(cache_dir, f"{source['name']}_{region}_{key}_{checksum[:16]}.parquet")
+    if os.path.isfile(parsed_path):
+        return pd.read_parquet(kp.read_path(parsed_path))
+
+    df = _typed(parse(path, region, source['years']))
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, parsed_path)
+    return df
+
+
+def pep_load(region, sources=sources, cache_dir=c.filenamer('data/cache/pep'), max_workers=c.pep_fetch_workers):
+    """
+    Fetch the population estimates of a geographical level from all of its sources concurrently, and
+    stitch them into one frame, each source contributing the years it covers.
+
+    Parameters
+    ----------
+    region : str
+        Geographical level of the data. Options: the keys of c.geographies
+
+    sources : list
+        The sources, as in the sources registry
+
+    cache_dir : str
+        Directory of the downloaded and parsed files
+
+    max_workers : int
+        Maximum number of sources fetched at once
+
+    Returns
+    -------
+    DataFrame
+        The population estimates, with columns fips, region, time, and population
+    """
+    region_sources = [source for source in sources if 'urls' not in source or region in source['urls']]
+    os.makedirs(cache_dir, exist_ok=True)
+
+    parent = kp.context()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        frames = list(
+            pool.map(lambda source: kp.in_context(parent, _source_load, source, region, cache_dir), region_sources)
+        )
+
+    # Overlapping sources are reported as duplicates rather than one silently replacing the other
+    df = pd.concat(
+        frame[frame['time'].between(start, end if end is not None else float('inf'))]
+        for frame, (start, end) in zip(frames, (source['years'] for source in region_sources))
+    )
+
+    duplicates = df.duplicated(['fips', 'time'])
+    if duplicates.any():
+        raise ValueError(f"Duplicate population estimates for {df.loc[duplicates, ['fips', 'time']].values.tolist()[:5]}")
+    return df.\
+        sort_values(['fips', 'region', 'time']).\
+        reset_index(drop=True)
+
+
+kp.instrument_module(sys.modules[__name__], ['_statab_parse', '_kauffman_pep', '_source_load', 'pep_load'])
@@ -0,0 +1,315 @@
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import functools
+import tracemalloc
+import pandas as pd
+import tools.constants as c
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+settings = {
+    'enabled': True,
+    'mode': None,
+    'report_path': c.filenamer('data/reports/kese_run_report')
+}
+
+_run = {'started': None, 'wall': time.perf_counter(), 'cpu': time.process_time()}
+_calls = []
+_events = []
+_profiles = []
+_local = threading.local()
+_lock = threading.Lock()  # the frame of a call is updated by the calls nested in it on other threads
+
+
+def _stack():
+    """Return the stack of instrumented calls running on the current thread."""
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def context():
+    """Return the frame of the instrumented call running on the current thread, or None."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def in_context(frame, func, *args, **kwargs):
+    """
+    Call func as a call nested in frame, an instrumented call of another thread from context(). Functions
+    submitted to a thread pool are called through it, so that the instrumented calls they make are
+    recorded as children of the call that submitted them, and their time and bytes are added to it.
+    """
+    stack = _stack()
+    if frame is not None:
+        stack.append(frame)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if frame is not None:
+            stack.pop()
+
+
+def _rows(obj):
+    """Return the number of rows of a DataFrame, or of the DataFrames in a tuple, list, or dict."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        return sum(_rows(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(_rows(item) for item in obj.values())
+    return 0
+
+
+def _peak_rss_mb():
+    """Return the peak resident set size of the process in megabytes, or None if it is not available."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1
+    )
+
+
+def record_io(read=0, written=0):
+    """Add bytes read and written to the instrumented call running on the current thread."""
+    stack = _stack()
+    if stack:
+        with _lock:
+            stack[-1]['bytes_read'] += read
+            stack[-1]['bytes_written'] += written
+
+
+def read_path(path):
+    """Record the size of a local file as bytes read by the current call. Returns the path."""
+    record_io(read=os.path.getsize(path))
+    return path
+
+
+def written_path(path):
+    """Record the size of a local file as bytes written by the current call. Returns the path."""
+    record_io(written=os.path.getsize(path))
+    return path
+
+
+def log(message):
+    """Print a progress message and add it, with the call it was made from, to the run report."""
+    stack = _stack()
+    _events.append(
+        {
+            'seconds': round(time.perf_counter() - _run['wall'], 3),
+            'stage': stack[-1]['stage'] if stack else None,
+            'message': message.strip()
+        }
+    )
+    sys.stdout.write(f'{message}\n')  # a single write, so messages from concurrent stages do not interleave
+
+
+def instrument(func):
+    """
+    Record the wall time, CPU time, rows in and out, and bytes read and written of each call of a
+    function. Times and bytes are inclusive of nested instrumented calls, including those run on a
+    thread pool through in_context; the self time excludes them. Nested calls that run concurrently
+    can add up to more than the wall time of their parent, whose self time is then 0.
+
+    With settings['mode'] set to 'cprofile', the outermost instrumented call of each thread is also
+    profiled. With 'tracemalloc', the net memory allocated by each call is recorded.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not settings['enabled']:
+            return func(*args, **kwargs)
+
+        stack = _stack()
+        frame = {'stage': func.__name__, 'bytes_read': 0, 'bytes_written': 0, 'child_seconds': 0.}
+        profile = cProfile.Profile() \
+            if settings['mode'] == 'cprofile' and not getattr(_local, 'profiling', False) else None
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+        stack.append(frame)
+        out = None
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if profile:
+            _local.profiling = True
+            profile.enable()
+        try:
+            out = func(*args, **kwargs)
+            return out
+        finally:
+            if profile:
+                profile.disable()
+                _local.profiling = False
+                _profiles.append(profile)
+            seconds = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            stack.pop()
+            if stack:
+                with _lock:
+                    stack[-1]['bytes_read'] += frame['bytes_read']
+                    stack[-1]['bytes_written'] += frame['bytes_written']
+                    stack[-1]['child_seconds'] += seconds
+
+            _calls.append(
+                {
+                    'stage': func.__name__,
+                    'module': func.__module__,
+                    'parent': stack[-1]['stage'] if stack else None,
+                    'thread': threading.current_thread().name,
+                    'start': round(wall - _run['wall'], 6),
+                    'seconds': round(seconds, 6),
+                    'self_seconds': round(max(seconds - frame['child_seconds'], 0.), 6),
+                    'cpu_seconds': round(cpu, 6),
+                    'traced_mb': round((tracemalloc.get_traced_memory()[0] - traced) / 1024 ** 2, 3)
+                    if traced is not None and tracemalloc.is_tracing() else None,
+                    'rows_in': _rows([args, list(kwargs.values())]),
+                    'rows_out': _rows(out),
+                    'bytes_read': frame['bytes_read'],
+                    'bytes_written': frame['bytes_written']
+                }
+            )
+    wrapper._instrumented = True
+    return wrapper
+
+
+def instrument_module(module, names):
+    """
+    Wrap the functions of a module named in names with instrument. Only the pipeline stages and the
+    functions that read or write data are instrumented, not the small helpers they call.
+    """
+    for name in names:
+        obj = getattr(module, name)
+        if not getattr(obj, '_instrumented', False):
+            setattr(module, name, instrument(obj))
+
+
+def run_start(mode=None):
+    """
+    Start a new run report, discarding the calls recorded so far.
+
+    Parameters
+    ----------
+    mode : str
+        None, 'cprofile' to profile the instrumented calls, or 'tracemalloc' to trace memory allocations.
+        Both slow the pipeline down.
+    """
+    if mode not in (None, 'cprofile', 'tracemalloc'):
+        raise ValueError(f"mode must be None, 'cprofile', or 'tracemalloc', not {mode!r}")
+    settings['mode'] = mode
+    _calls.clear()
+    _events.clear()
+    _profiles.clear()
+    _run.update(
+        started=pd.Timestamp.now().isoformat(timespec='seconds'), wall=time.perf_counter(), cpu=time.process_time()
+    )
+    if mode == 'tracemalloc':
+        tracemalloc.start()
+
+
+def _stage_summary():
+    """Aggregate the recorded calls by stage."""
+    if not _calls:
+        return pd.DataFrame()
+    return pd.DataFrame(_calls).\
+        groupby(['module', 'stage'], as_index=False).\
+        agg(
+            calls=('seconds', 'size'),
+            seconds=('seconds', 'sum'),
+            self_seconds=('self_seconds', 'sum'),
+            cpu_seconds=('cpu_seconds', 'sum'),
+            rows_in=('rows_in', 'sum'),
+            rows_out=('rows_out', 'sum'),
+            bytes_read=('bytes_read', 'sum'),
+            bytes_written=('bytes_written', 'sum'),
+            traced_mb=('traced_mb', 'max')
+        ).\
+        sort_values('self_seconds', ascending=False).\
+        reset_index(drop=True)
+
+
+def _report_text(report, df_stages, profile_text, traced_text):
+    """Format the run report for reading."""
+    lines = [
+        f"KESE run report, started {report['started']}",
+        f"wall {report['seconds']:.2f}s, cpu {report['cpu_seconds']:.2f}s, peak rss {report['peak_rss_mb']} MB",
+        ''
+    ]
+    if not df_stages.empty:
+        lines.append(
+            df_stages.\
+                assign(
+                    mb_read=lambda x: (x['bytes_read'] / 1024 ** 2).round(1),
+                    mb_written=lambda x: (x['bytes_written'] / 1024 ** 2).round(1)
+                ).\
+                drop(columns=['module', 'bytes_read', 'bytes_written']).\
+                round(3).\
+                to_string(index=False)
+        )
+    for title, text in [('cProfile, top functions by cumulative time', profile_text), ('tracemalloc', traced_text)]:
+        if text:
+            lines += ['', title, text]
+    return '\n'.join(lines) + '\n'
+
+
+def run_report(path=None):
+    """
+    Write the report of the current run to {path}.json and {path}.txt, and print the latter. In
+    'cprofile' mode the profile is also saved to {path}.prof.
+
+    Parameters
+    ----------
+    path : str
+        Path of the report, without extension. Defaults to settings['report_path'].
+
+    Returns
+    -------
+    dict
+        The report
+    """
+    path = path or settings['report_path']
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df_stages = _stage_summary()
+
+    report = {
+        'started': _run['started'],
+        'mode': settings['mode'],
+        'seconds': round(time.perf_counter() - _run['wall'], 6),
+        'cpu_seconds': round(time.process_time() - _run['cpu'], 6),
+        'peak_rss_mb': _peak_rss_mb(),
+        'stages': df_stages.to_dict(orient='records'),
+        'calls': list(_calls),
+        'events': list(_events)
+    }
+
+    profile_text = None
+    if _profiles:
+        stats = pstats.Stats(*_profiles, stream=io.StringIO())
+        stats.dump_stats(f'{path}.prof')
+        stats.sort_stats('cumulative').print_stats(25)
+        profile_text = stats.stream.getvalue().strip()
+
+    traced_text = None
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report['traced_peak_mb'] = round(peak / 1024 ** 2, 3)
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        tracemalloc.stop()
+        traced_text = '\n'.join(
+            [f'peak {peak / 1024 ** 2:.1f} MB, top allocations still held:'] + [str(stat) for stat in top]
+        )
+
+    with open(f'{path}.json', 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    text = _report_text(report, df_stages, profile_text, traced_text)
+    with open(f'{path}.txt', 'w') as f:
+        f.write(text)
+    print(text)
+    return report
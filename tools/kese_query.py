@@ -0,0 +1,227 @@
+import os
+import json
+import threading
+import pandas as pd
+import tools.constants as c
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+settings = {
+    'path': c.filenamer(f'data/kcr_calc_{c.vintage}_kese_download.csv'),
+    'poll_seconds': 1.
+}
+
+_state = {'index': None}
+_lock = threading.Lock()
+
+
+def _read(path):
+    """Read the download-version of the data, as written by _outputs_save in csv or Parquet."""
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, dtype={'fips': str, 'name': str, 'type': str, 'category': str})
+    return df.astype({'fips': str, 'name': str, 'type': str, 'category': str, 'year': int})
+
+
+def _index_build(df):
+    """
+    Build the index of the data: every slice that can be queried is computed once, as a list of
+    records, so that a query is a single dict lookup.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data, as produced by _final_data_transform
+
+    Returns
+    -------
+    dict
+        The records keyed by (fips, type, category, year) ('cells'), the time series keyed by
+        (fips, type, category) ('series'), and the cross-sections keyed by (type, category, year)
+        ('years')
+    """
+    df = df.sort_values(['fips', 'type', 'category', 'year']).reset_index(drop=True)
+    # Missing values become None, i.e. null in JSON
+    records = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+    keys = list(zip(df['fips'], df['type'], df['category'], df['year'].tolist()))
+    series = {}
+    years = {}
+    for key, record in zip(keys, records):
+        fips, type_, category, year = key
+        series.setdefault((fips, type_, category), []).append(record)
+        years.setdefault((type_, category, year), []).append(record)
+
+    return {'cells': dict(zip(keys, records)), 'series': series, 'years': years, 'rows': len(records)}
+
+
+def reload(path=None):
+    """
+    Load the data at path into the index if it changed since it was last loaded. The new index replaces
+    the old one in a single assignment, so queries running concurrently see either the old or the new
+    data, never a mix. _outputs_save replaces the output files atomically, so a run that is still writing
+    is never read.
+
+    Parameters
+    ----------
+    path : str
+        Location of the download-version of the data. Defaults to settings['path'].
+
+    Returns
+    -------
+    bool
+        Whether the index was reloaded
+    """
+    path = path or settings['path']
+    with _lock:
+        st = os.stat(path)
+        stat = (path, st.st_mtime_ns, st.st_size)
+        if _state['index'] is not None and _state['index']['stat'] == stat:
+            return False
+        index = _index_build(_read(path))
+        index.update(stat=stat, loaded=pd.Timestamp.now().isoformat(timespec='seconds'))
+        _state['index'] = index
+    return True
+
+
+def watch(path=None, poll_seconds=None, stop=None):
+    """
+    Reload the index in a background thread whenever the data at path changes, e.g. when a new run of
+    kese_data_create_all finishes, until the threading.Event stop is set. Returns the thread.
+    """
+    stop = stop or threading.Event()
+
+    def _watch():
+        while not stop.wait(poll_seconds or settings['poll_seconds']):
+            try:
+                reload(path)
+            except (FileNotFoundError, ValueError, OSError):  # the file is missing or mid-replacement
+                pass
+
+    reload(path)
+    thread = threading.Thread(target=_watch, name='kese_query_watch', daemon=True)
+    thread.start()
+    return thread
+
+
+def _loaded():
+    """Return the current index, loading it on first use."""
+    if _state['index'] is None:
+        reload()
+    return _state['index']
+
+
+def cell(fips, type_, category, year):
+    """Return the record of one (fips, type, category, year), or None if there is none."""
+    return _loaded()['cells'].get((fips, type_, category, year))
+
+
+def series(fips, type_='Total', category='Total'):
+    """Return the time series of one geography and demographic, e.g. a state's, sorted by year."""
+    return _loaded()['series'].get((fips, type_, category), [])
+
+
+def year(year, type_='Total', category='Total'):
+    """Return the records of all geographies for one year and demographic, e.g. all states in a year, sorted by fips."""
+    return _loaded()['years'].get((type_, category, year), [])
+
+
+def demographic(type_, category, fips='00'):
+    """Return the time series of one demographic, e.g. type 'Sex' and category 'Women', across years."""
+    return series(fips, type_, category)
+
+
+def info():
+    """Return the path, load time, and number of rows of the data in the index."""
+    index = _loaded()
+    return {'path': index['stat'][0], 'loaded': index['loaded'], 'rows': index['rows']}
+
+
+# The parameters of each path, with the argument of the query function and the type they map to
+_routes = {
+    '/cell': (cell, {'fips': ('fips', str), 'type': ('type_', str), 'category': ('category', str), 'year': ('year', int)}),
+    '/series': (series, {'fips': ('fips', str), 'type': ('type_', str), 'category': ('category', str)}),
+    '/year': (year, {'year': ('year', int), 'type': ('type_', str), 'category': ('category', str)}),
+    '/demographic': (demographic, {'type': ('type_', str), 'category': ('category', str), 'fips': ('fips', str)}),
+    '/info': (info, {})
+}
+
+
+class _QueryServer(ThreadingHTTPServer):
+    """A threading HTTP server that also stops the watcher of its data when it is shut down."""
+    daemon_threads = True
+
+    def __init__(self, address, handler, watch_stop):
+        super().__init__(address, handler)
+        self.watch_stop = watch_stop
+
+    def shutdown(self):
+        self.watch_stop.set()
+        super().shutdown()
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    """Answer GET /cell, /series, /year, /demographic, and /info with JSON, e.g. /series?fips=06."""
+    protocol_version = 'HTTP/1.1'  # keep connections alive between requests
+    disable_nagle_algorithm = True  # otherwise the body, sent after the headers, waits for the client's delayed ACK
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path not in _routes:
+            return self._send(404, {'error': f'unknown path {url.path}', 'paths': list(_routes)})
+
+        func, params = _routes[url.path]
+        try:
+            kwargs = {}
+            for key, values in parse_qs(url.query).items():
+                if key not in params:
+                    raise ValueError(f'unknown parameter {key}. Options: {list(params)}')
+                arg, kind = params[key]
+                kwargs[arg] = kind(values[-1])
+            return self._send(200, func(**kwargs))
+        except (TypeError, ValueError) as e:  # missing or malformed parameters
+            return self._send(400, {'error': str(e)})
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=8050, path=None, poll_seconds=None):
+    """
+    Serve the index over HTTP, reloading it when the data changes. Returns the server, running in a
+    background thread; stop it, and the reloading, with server.shutdown().
+
+    Parameters
+    ----------
+    host : str
+        Address to listen on
+
+    port : int
+        Port to listen on; 0 picks a free port, available as server.server_port
+
+    path : str
+        Location of the download-version of the data. Defaults to settings['path'].
+
+    poll_seconds : float
+        Seconds between checks for new data. Defaults to settings['poll_seconds'].
+    """
+    stop = threading.Event()
+    watch(path, poll_seconds, stop)
+    server = _QueryServer((host, port), _QueryHandler, stop)
+    threading.Thread(target=server.serve_forever, name='kese_query_serve', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    server = serve()
+    print(f'Serving KESE indicators at http://{server.server_address[0]}:{server.server_port}')
+    threading.Event().wait()
@@ -1,34 +1,24 @@
-import sys
-import boto3
-import joblib
+import os
+import hashlib
 import pandas as pd
 import tools.constants as c
 import tools.kese_helpers as h
-from kauffman.data import bed, pep
-from kauffman.tools import file_to_s3
+import tools.kese_pep as kpep
+from concurrent.futures import ThreadPoolExecutor
 
 
-def _cps():
-    df_us = pd.DataFrame()
-    df_state = pd.DataFrame()
-    for year in range(1996, 2022):
-        df_in = pd.read_csv(f'https://people.ucsc.edu/~rfairlie/data/microdata/kieadata{year}.csv')
-
-        df_us = df_us.append(h.preprocess_cps(df_in, 'us'))
-        df_state = df_state.append(h.preprocess_cps(df_in, 'state'))
-    return df_us, df_state
-
-
-def raw_data_update():
+def raw_data_update(regions=('us', 'state')):
+    import joblib
+    from kauffman.data import bed
     joblib.dump(str(pd.to_datetime('today')), c.filenamer('data/raw_data/raw_data_fetch_time.pkl'))
 
     # CPS
-    df_us, df_state = _cps()
+    df_us, df_state = h.cps_fetch()
     df_us.to_csv(c.filenamer(f'data/raw_data/cps_us.csv'), index=False)
     df_state.to_csv(c.filenamer(f'data/raw_data/cps_state.csv'), index=False)
 
 
-    for region in ['us', 'state']:
+    for region in regions:
         # BED
         bed(series='establishment age and survival', table='1bf', obs_level=region). \
             to_csv(c.filenamer(f'data/raw_data/bed_table1_{region}.csv'), index=False)
@@ -39,24 +29,108 @@ def raw_data_update():
             to_csv(c.filenamer(f'data/raw_data/bed_table7_{region}.csv'), index=False)
 
         # PEP
-        pep(region). \
-            rename(columns={'POP': 'population'}). \
-            astype({'time': 'int', 'population': 'int'}). \
-            query('time >= 2000'). \
-            append(h.pep_pre_2000(region)). \
-            sort_values(['fips', 'region', 'time']). \
-            reset_index(drop=True).\
-            to_csv(c.filenamer(f'data/raw_data/pep_{region}.csv'), index=False)
-
-
-def s3_update():
-    files_lst = [
-        'raw_data_fetch_time.pkl', 'cps_us.csv', 'cps_state.csv', 'pep_us.csv', 'pep_state.csv',
-        'bed_table1_us.csv', 'bed_table1_state.csv', 'bed_table7_us.csv', 'bed_table7_state.csv'
+        kpep.pep_load(region).to_csv(c.filenamer(f'data/raw_data/pep_{region}.csv'), index=False)
+
+
+def _md5(path):
+    """Return the hex MD5 of the content of a file."""
+    m = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            m.update(block)
+    return m.hexdigest()
+
+
+def _s3_file_plan(client, path, bucket, key):
+    """
+    Compare a local file with the S3 object at key. Returns the action, 'upload' or 'skip', and its reason.
+
+    Objects uploaded by s3_sync carry the MD5 of their content in their metadata, since the ETag of a
+    multipart upload is not an MD5. For other objects, the ETag is used when it is a plain MD5.
+    """
+    from botocore.exceptions import ClientError
+    try:
+        remote = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return 'upload', 'new', None
+        raise
+
+    if remote['ContentLength'] != os.path.getsize(path):
+        return 'upload', 'size changed', None
+    md5 = _md5(path)
+    remote_md5 = remote.get('Metadata', {}).get('md5') or \
+        (remote['ETag'].strip('"') if '-' not in remote['ETag'] else None)
+    if remote_md5 != md5:
+        return 'upload', 'content changed', md5
+    return 'skip', 'unchanged', md5
+
+
+def s3_sync(files, bucket, prefix, dry_run=False, client=None, max_workers=c.s3_workers):
+    """
+    Upload local files to S3, skipping those whose size and MD5 match the existing object. Files are
+    compared and uploaded concurrently over one pooled client, and large files are uploaded in parts.
+
+    Parameters
+    ----------
+    files : list
+        Paths of the local files
+
+    bucket : str
+        The S3 bucket
+
+    prefix : str
+        The key prefix under which the files are stored, by file name
+
+    dry_run : bool
+        When true, the plan is printed but nothing is uploaded.
+
+    client : botocore client
+        The S3 client. A new one is created if None, e.g. pass one with an endpoint_url to use a local
+        S3 stand-in such as MinIO.
+
+    max_workers : int
+        Maximum number of files compared and uploaded at once
+
+    Returns
+    -------
+    DataFrame
+        The plan: one row per file with its key, action, and the reason for it
+    """
+    import boto3
+    from botocore.config import Config
+    from boto3.s3.transfer import TransferConfig
+    client = client or boto3.client('s3', config=Config(max_pool_connections=max_workers))
+    transfer_config = TransferConfig(
+        multipart_threshold=c.s3_multipart_threshold, multipart_chunksize=c.s3_multipart_chunksize
+    )
+    keys = [f'{prefix}/{os.path.basename(path)}' for path in files]
+
+    def _sync(path, key):
+        action, reason, md5 = _s3_file_plan(client, path, bucket, key)
+        if action == 'upload' and not dry_run:
+            client.upload_file(
+                path, bucket, key, ExtraArgs={'Metadata': {'md5': md5 or _md5(path)}}, Config=transfer_config
+            )
+        return key, action, reason
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        df_plan = pd.DataFrame(list(pool.map(_sync, files, keys)), columns=['key', 'action', 'reason'])
+
+    print(f"{'Planned' if dry_run else 'Synced'} s3://{bucket}/{prefix}:")
+    print(df_plan.to_string(index=False))
+    return df_plan
+
+
+def s3_update(regions=('us', 'state'), dry_run=False, client=None):
+    files_lst = ['raw_data_fetch_time.pkl', 'cps_us.csv', 'cps_state.csv'] + [
+        f'{name}_{region}.csv' for name in ['pep', 'bed_table1', 'bed_table7'] for region in regions
     ]
 
-    for file in files_lst:
-        file_to_s3(c.filenamer(f'data/raw_data/{file}'), 'emkf.data.research', f'indicators/kese/raw_data/{file}')
+    return s3_sync(
+        [c.filenamer(f'data/raw_data/{file}') for file in files_lst], c.s3_bucket, c.s3_raw_data_prefix,
+        dry_run, client
+    )
 
 
 def main():
@@ -0,0 +1,78 @@
+import pandas as pd
+import tools.constants as c
+
+# The dtype of each column of the pipeline frames.
+#
+# Keys are categorical: each distinct fips code, name, type, or category is stored once, e.g. 'United
+# States' on every row of the US-level data, and merges and groupbys compare integer codes. Years fit
+# in int16. BED counts and the population are nullable integers, since left merges leave them missing
+# for some years; int32 holds the largest of them with room to spare. The population is rounded first:
+# the 1996 - 1999 state estimates are published in thousands, and scaling them by 1000 leaves float
+# artifacts such as 32987675.000000004.
+#
+# Floats are float32 only where that is lossless: the BED survival rates and average employment are
+# published with at most two decimals, well within the ~7 significant digits of float32. RNE and OSE,
+# their standard errors, and the indicators derived from them, stay float64, since they are published at full precision and
+# a float32 round trip would change them by up to ~6e-8 relative to the current outputs.
+dtypes = {
+    'fips': 'category',
+    'region': 'category',
+    'name': 'category',
+    'type': 'category',
+    'category': 'category',
+
+    'time': 'int16',
+    'year': 'int16',
+    'end_year': 'int16',
+    'firm_age': 'int16',
+
+    'firms': 'Int32',
+    'establishments': 'Int32',
+    'Lestablishments': 'Int32',
+    'employment': 'Int32',
+    'net_change': 'Int32',
+    'total_job_gains': 'Int32',
+    'expanding_job_gains': 'Int32',
+    'opening_job_gains': 'Int32',
+    'total_job_losses': 'Int32',
+    'contracting_job_losses': 'Int32',
+    'closing_job_losses': 'Int32',
+    'population': 'Int32',
+
+    'survival_since_birth': 'float32',
+    'survival_previous_year': 'float32',
+    'average_emp': 'float32',
+
+    'rne': 'float64',
+    'ose': 'float64',
+    'rne_se': 'float64',
+    'ose_se': 'float64',
+    'sjc': 'float64',
+    'ssr': 'float64',
+    'zindex': 'float64'
+}
+
+
+def schema_apply(df, region):
+    """
+    Convert the columns of a frame to the dtypes in dtypes. fips codes are zero-padded to the width of
+    the geographical level first, since they are read from csv as integers.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data
+
+    region : str
+        Geographical level of the data. Options: the keys of c.geographies
+
+    Returns
+    -------
+    DataFrame
+        The data, with its columns converted. Columns not in dtypes are left as they are.
+    """
+    if 'fips' in df.columns and not isinstance(df['fips'].dtype, pd.CategoricalDtype):
+        df = df.assign(fips=df['fips'].astype(str).str.zfill(c.geographies[region]['fips_width']))
+    if 'population' in df.columns and df['population'].dtype.kind == 'f':
+        df = df.assign(population=df['population'].round())
+    return df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
@@ -0,0 +1,135 @@
+import sys
+import numpy as np
+import pandas as pd
+import tools.constants as c
+import tools.kese_profile as kp
+
+settings = {
+    'enabled': True,
+    'on_error': 'raise'
+}
+
+_keys = ['fips', 'type', 'category', 'time']
+
+
+def _codes(col):
+    """Return the integer codes of a key column and their number, from its categories if it is categorical."""
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy('int64'), len(col.cat.categories)
+    codes, uniques = pd.factorize(col)
+    return codes.astype('int64'), len(uniques)
+
+
+def _panel(df):
+    """
+    Sort the rows of the merged data by an integer encoding of (fips, type, category, time).
+
+    Returns
+    -------
+    tuple
+        The order of the rows, and for each row in that order the code of its (fips, type, category)
+        group and its year
+    """
+    group = np.zeros(len(df), dtype='int64')
+    for key in _keys[:-1]:
+        codes, n = _codes(df[key])
+        group = group * n + codes
+    time = df['time'].to_numpy('int64')
+    order = np.lexsort((time, group))
+    return order, group[order], time[order]
+
+
+def _failure(report, check, column, severity, mask, df, order=None):
+    """Add a check to the report, with the number of failing rows and the keys of the first three."""
+    failures = np.flatnonzero(mask)
+    if order is not None:
+        failures = order[failures]
+    examples = df.iloc[failures[:3]][_keys].astype(str).agg('/'.join, axis=1).tolist() if len(failures) else []
+    report.append(
+        {'check': check, 'column': column, 'severity': severity, 'failures': len(failures), 'examples': examples}
+    )
+
+
+def merged_validate(df, region):
+    """
+    Check the merged raw data of a geographical level before the indicators are calculated from it,
+    with vectorized operations over the whole frame:
+
+    * keys: (fips, type, category, time) is unique
+    * panel: every (fips, type, category) has every year from the first to the last year of the data
+    * missing: the inputs of the indicators are present: RNE and OSE at levels covered by the CPS, and
+      the BED counts and population of the Total rows
+    * range: RNE and OSE, and their standard errors, are in [0, 1], the population and the lagged BED
+      establishments are positive, and the BED counts are non-negative
+    * jump: the population and the BED counts change from one year to the next by at most the ratios in
+      c.validation_jumps, in the Total rows. Jumps are reported as warnings, since real data has them
+      too.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The merged raw data, from _raw_data_merge
+
+    region : str
+        Geographical level of the data. Options: the keys of c.geographies
+
+    Returns
+    -------
+    DataFrame
+        One row per check and column, with the severity ('error' or 'warning'), the number of failing
+        rows, and the keys of the first three
+    """
+    report = []
+    order, group, time = _panel(df)
+    same_group = np.r_[False, group[1:] == group[:-1]]
+
+    duplicate = same_group & np.r_[False, time[1:] == time[:-1]]
+    _failure(report, 'keys', 'fips/type/category/time', 'error', duplicate, df, order)
+
+    # A group is complete if it has a row for every year of the data
+    first, last = (time.min(), time.max()) if len(time) else (0, 0)
+    starts = np.flatnonzero(~same_group)
+    ends = np.r_[starts[1:], len(group)] - 1
+    years = np.add.reduceat(~duplicate, starts) if len(starts) else starts
+    incomplete = (time[starts] != first) | (time[ends] != last) | (years != last - first + 1)
+    _failure(report, 'panel', f'years {first}-{last}', 'error', np.isin(group, group[starts[incomplete]]), df, order)
+
+    total = (df['category'] == 'Total').to_numpy()
+    inputs = (['rne', 'ose'] if c.geographies[region]['cps'] else []) + \
+        ['opening_job_gains', 'establishments', 'Lestablishments', 'population']
+    values = {
+        col: df[col].to_numpy('float64', na_value=np.nan)
+        for col in {*inputs, *c.validation_ranges, *c.validation_jumps} if col in df.columns
+    }
+    for col in inputs:
+        missing = np.isnan(values[col]) if col in values else np.ones(len(df), dtype=bool)
+        _failure(report, 'missing', col, 'error', missing if col in ('rne', 'ose') else missing & total, df)
+
+    for col, (low, high, closed) in c.validation_ranges.items():
+        if col in values:
+            x = values[col]
+            outside = (x < low if closed[0] else x <= low) | (x > high if closed[1] else x >= high)
+            _failure(report, 'range', col, 'error', outside, df)
+
+    # Consecutive years of the same group, in the sorted panel. The population and BED counts are the same
+    # for every category of a fips, so only the Total rows are checked.
+    consecutive = same_group & np.r_[False, time[1:] - time[:-1] == 1] & total[order]
+    for col, ratio in c.validation_jumps.items():
+        if col in values:
+            x = values[col][order]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                change = np.abs(np.log(x[1:] / x[:-1]))
+            _failure(report, 'jump', col, 'warning', consecutive & np.r_[False, change > np.log(ratio)], df, order)
+
+    return pd.DataFrame(report)
+
+
+def report_text(report, region):
+    """Format the failing checks of a validation report, one line each."""
+    return '\n'.join(
+        f"\t{region} {row.severity} {row.check} {row.column}: {row.failures} rows, e.g. {', '.join(row.examples)}"
+        for row in report.query('failures > 0').itertuples()
+    )
+
+
+kp.instrument_module(sys.modules[__name__], ['merged_validate'])